@@ -3,34 +3,126 @@ API Gateway/Proxy to manage all the microservices
 This gateway integrates all the APIs we've been testing into a single entry point
 """
 
-from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, Path
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, Path, WebSocket
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.routing import Route
-import requests
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.websockets import WebSocketState
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import httpx
 import json
-from typing import Optional, Dict, Any, Annotated
+from typing import Optional, Dict, Any, Annotated, Tuple
 import asyncio
-from urllib.parse import urljoin, urlparse
+import atexit
+import base64
+from bisect import bisect_left, insort
+import gzip
+import hashlib
+import heapq
+import importlib.util
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import math
+from urllib.parse import parse_qsl, quote, urlencode, urljoin, urlparse
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
+import unicodedata
+import zlib
+from datetime import datetime, timezone
+
+# Access log settings: 2xx/3xx requests are logged with probability ACCESS_LOG_SAMPLE_RATE,
+# errors (>= 400) and requests slower than ACCESS_LOG_SLOW_MS always
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get("ACCESS_LOG_SAMPLE_RATE", "0.1"))
+ACCESS_LOG_SLOW_MS = float(os.environ.get("ACCESS_LOG_SLOW_MS", "1000"))
+
+# Query parameters whose values never reach the logs (the realtime routes take the token in the URL)
+SECRET_PARAM_PATTERN = re.compile(r"token|password|secret|key|auth|session|signature", re.IGNORECASE)
+
+
+class GatewayLogFormatter(logging.Formatter):
+    """Access records as one JSON object per line, everything else in the usual text format"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        access = getattr(record, "access", None)
+        if access is None:
+            return super().format(record)
+        return json.dumps({"ts": self.formatTime(record), "type": "access", **access}, separators=(",", ":"))
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves the formatting to the listener thread.
+    The stock handler formats in the calling thread so records can be pickled, which a
+    thread queue doesn't need; request handlers only pay for enqueueing the record.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure_logging() -> QueueListener:
+    """
+    Route every log record through a queue to a background thread that formats and writes it,
+    so slow stdout/stderr never blocks the event loop
+    """
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(GatewayLogFormatter("%(levelname)s:%(name)s:%(message)s"))
+    log_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    logging.basicConfig(level=logging.INFO, handlers=[DeferredQueueHandler(log_queue)], force=True)
+    # httpx logs every upstream call at INFO, query string included; the access log covers them
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener.start()
+    # Write out what is still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
 
-# Disable SSL warnings for self-signed certificates
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(f"{__name__}.access")
 
 from pydantic import ConfigDict, constr
 
+try:
+    import brotli
+except ImportError:  # Responses are then only compressed with gzip
+    brotli = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open/close shared gateway resources around the application lifetime"""
+    presence_flush = asyncio.ensure_future(presence_table.run_flush_loop())
+    yield
+    presence_flush.cancel()
+    # Don't lose the heartbeats received since the last flush
+    await presence_table.flush()
+    await command_jobs.close()
+    await GatewayService.close_clients()
+    answer_cache.close()
+    tracer.shutdown()
+
+
 app = FastAPI(
     title="API Gateway",
     description="Gateway to manage all the microservices",
     version="1.0.0",
     # Disable automatic UUID parsing
     openapi_url="/openapi.json",
-    docs_url="/docs"
+    docs_url="/docs",
+    lifespan=lifespan
 )
 
 # CORS is handled by the Ingress Controller - no need to add CORS middleware here
@@ -45,122 +137,2845 @@ app = FastAPI(
 #     max_age=3600,
 # )
 
-# Service registry - mapping of service names to their base URLs
+# Default connection pool and timeout settings, each one can be overridden per service below
+DEFAULT_SERVICE_CONFIG = {
+    "max_connections": 100,      # Upper bound of open connections to the service
+    "max_keepalive": 20,         # Idle connections kept open for reuse
+    "keepalive_expiry": 30.0,    # Seconds an idle connection stays in the pool
+    "connect_timeout": 5.0,      # Seconds to establish a TCP/TLS connection
+    "timeout": 30.0,             # Seconds for the whole read/write of a request
+    "http2": True,               # Negotiated via ALPN, plain http:// services stay on HTTP/1.1
+    "breaker_window": 20,        # Number of recent calls the circuit breaker looks at
+    "breaker_min_calls": 10,     # Calls needed in the window before the breaker can open
+    "breaker_failure_rate": 0.5, # Failure ratio in the window that opens the breaker
+    "breaker_open_seconds": 30.0,  # Seconds requests fail fast before probing again
+    "breaker_half_open_probes": 2, # Successful probes needed to close the breaker again
+    "route_class": "interactive",  # Bulkhead of ROUTE_CLASS_LIMITS shared with the other services of the class
+    "max_concurrent": 100,       # Calls in flight to the service at once
+    "max_queue": 200,            # Calls waiting for a slot before new ones get a 503
+    "health_path": "/health",    # Probed by /health/deep, any status below 500 counts as up
+}
+
+# Service registry - mapping of service names to their base URLs and connection settings
 SERVICE_REGISTRY = {
-    "users": "https://users.inf326.nursoft.dev/usersservice",
-    "channels": "https://channel-api.inf326.nur.dev",
-    "threads": "https://threads.inf326.nursoft.dev/threads",
-    "messages": "https://messages-service.kroder.dev",
-    "presence": "https://presence-134-199-176-197.nip.io",
-    "search": "https://searchservice.inf326.nursoft.dev",
-    "files": "http://file-service-134-199-176-197.nip.io",
-    "chatbot": "https://chatbotprogra.inf326.nursoft.dev",
-    "wikipedia": "https://wikipedia-chatbot.inf326.nursoft.dev"
+    "users": {"url": "https://users.inf326.nursoft.dev/usersservice"},
+    "channels": {"url": "https://channel-api.inf326.nur.dev"},
+    "threads": {"url": "https://threads.inf326.nursoft.dev/threads"},
+    "messages": {"url": "https://messages-service.kroder.dev", "max_keepalive": 40},
+    "presence": {"url": "https://presence-134-199-176-197.nip.io", "health_path": "/api/v1.0.0/presence/health"},
+    # The search service has no health route, probing its root avoids running a real query
+    "search": {"url": "https://searchservice.inf326.nursoft.dev", "route_class": "search", "health_path": "/"},
+    "files": {"url": "http://file-service-134-199-176-197.nip.io", "max_connections": 20, "timeout": 120.0,
+              "route_class": "files", "max_concurrent": 20, "max_queue": 40, "health_path": "/healthz"},
+    "chatbot": {"url": "https://chatbotprogra.inf326.nursoft.dev", "max_connections": 20, "timeout": 300.0,
+                "route_class": "bot", "max_concurrent": 12, "max_queue": 24},
+    "wikipedia": {"url": "https://wikipedia-chatbot.inf326.nursoft.dev", "max_connections": 20,
+                  "route_class": "bot", "max_concurrent": 12, "max_queue": 24}
+}
+
+# Base URLs can be overridden per service with <NAME>_SERVICE_URL (e.g. USERS_SERVICE_URL),
+# which is how the benchmark points the gateway at local stand-ins
+for _name, _config in SERVICE_REGISTRY.items():
+    _config["url"] = os.environ.get(f"{_name.upper()}_SERVICE_URL", _config["url"])
+
+# Concurrency limits per route class. Each class has its own pool of slots, so a burst of
+# bot commands can never take the capacity reserved for interactive routes (users, channels,
+# threads, messages, presence). queue_timeout is how long a call may wait for a free slot.
+ROUTE_CLASS_LIMITS = {
+    "interactive": {"max_concurrent": 200, "max_queue": 400, "queue_timeout": 5.0},
+    "search": {"max_concurrent": 50, "max_queue": 100, "queue_timeout": 2.0},
+    "files": {"max_concurrent": 20, "max_queue": 40, "queue_timeout": 10.0},
+    "bot": {"max_concurrent": 16, "max_queue": 32, "queue_timeout": 10.0},
 }
 
+# Overall deadline of the /health/deep probes and how long their result is reused
+DEEP_HEALTH_DEADLINE = 3.0
+DEEP_HEALTH_CACHE_SECONDS = 5.0
+
+# Upstream statuses counted as failures by the circuit breakers (besides timeouts and connection errors)
+BREAKER_FAILURE_STATUSES = {502, 503, 504}
+
+# Seconds a cached GET response stays fresh, per gateway route
+CACHE_TTLS = {
+    "list_channels": 15.0,
+    "get_channel": 30.0,
+    "get_channel_threads": 10.0,
+    "user_me": 60.0,  # Shortened to the token's expiry when the bearer token is a JWT
+    "thread_access": 60.0,  # Real-time subscription checks (see can_read_thread)
+}
+
+
+class ResponseCache:
+    """
+    Bounded in-memory LRU cache of successful upstream GET responses.
+    Entries are keyed by route, path, query params and the caller's Authorization and X-User-Id headers,
+    expire after the TTL of their route and carry a tag used to invalidate them on writes.
+    Invalidations bump a generation counter: a response fetched before a write invalidated
+    its tag isn't stored once it arrives (see set's since argument).
+    """
+
+    def __init__(self, ttls: Dict[str, float], max_entries: int = 1024, max_entry_size: int = 512 * 1024):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.max_entry_size = max_entry_size
+        # key -> (expires_at, tag, status_code, headers, body), oldest first
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.stats = {route: {"hits": 0, "misses": 0} for route in ttls}
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_writes = 0
+        # Generation of the last invalidation of each tag (and of each tag prefix)
+        self.generation = 0
+        self._tag_generations: Dict[str, int] = {}
+        self._prefix_generations: Dict[str, int] = {}
+
+    @staticmethod
+    def user_identity(headers: Dict) -> str:
+        """Identify the caller by a hash of its Authorization header"""
+        auth = headers.get("authorization", "")
+        return hashlib.sha256(auth.encode()).hexdigest() if auth else "anonymous"
+
+    @staticmethod
+    def make_key(route: str, path: str, params: Optional[Dict], headers: Dict) -> tuple:
+        """
+        Build the cache key of a request. Services like messages tell readers apart by X-User-Id, so
+        it is part of the key along with the token: callers differing in either never share an entry.
+        """
+        return (route, path, tuple(sorted((params or {}).items())), ResponseCache.user_identity(headers),
+                headers.get("x-user-id", ""))
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        """Return a fresh (status_code, headers, body) entry or None, counting the hit/miss"""
+        route_stats = self.stats.setdefault(key[0], {"hits": 0, "misses": 0})
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            route_stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        route_stats["hits"] += 1
+        return entry[2:]
+
+    def set(self, key: tuple, tag: str, status_code: int, headers: Dict, body: bytes, ttl: Optional[float] = None,
+            since: Optional[int] = None):
+        """
+        Store a response, evicting the least recently used entries past max_entries.
+        since is the generation the response was fetched at: it is dropped if its tag was invalidated after that.
+        """
+        if since is not None and self.invalidated_since(tag, since):
+            self.stale_writes += 1
+            return
+        if ttl is None:
+            ttl = self.ttls.get(key[0], 0)
+        if len(body) > self.max_entry_size or ttl <= 0:
+            return
+        expires_at = time.monotonic() + ttl
+        self._entries[key] = (expires_at, tag, status_code, headers, body)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidated_since(self, tag: str, generation: int) -> bool:
+        if self._tag_generations.get(tag, 0) > generation:
+            return True
+        return any(tag.startswith(prefix) for prefix, invalidated in self._prefix_generations.items()
+                   if invalidated > generation)
+
+    def invalidate(self, *tags: str, prefix: bool = False):
+        """Drop every entry whose tag is one of tags (or starts with one of them when prefix=True)"""
+        self.generation += 1
+        generations = self._prefix_generations if prefix else self._tag_generations
+        for tag in tags:
+            generations[tag] = self.generation
+        if prefix:
+            stale = [key for key, entry in self._entries.items() if entry[1].startswith(tags)]
+        else:
+            stale = [key for key, entry in self._entries.items() if entry[1] in tags]
+        for key in stale:
+            del self._entries[key]
+        self.invalidations += len(stale)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Counters used to tune the TTLs"""
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "stale_writes": self.stale_writes,
+            "routes": {route: {**counts, "ttl": self.ttls.get(route)} for route, counts in self.stats.items()},
+        }
+
+
+response_cache = ResponseCache(CACHE_TTLS)
+
+# Persistent answer cache of the bot commands (see AnswerCache)
+ANSWER_CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH", "answer_cache.sqlite3")
+ANSWER_CACHE_MAX_BYTES = int(os.environ.get("ANSWER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# TTL of the answers of each command and whether its messages are case sensitive (code is)
+ANSWER_CACHE_COMMANDS = {
+    "wikipedia": {"ttl": 7 * 24 * 3600.0, "case_sensitive": False},
+    "programming": {"ttl": 24 * 3600.0, "case_sensitive": False},
+    "code": {"ttl": 24 * 3600.0, "case_sensitive": True},
+}
+# Response headers stored with an answer
+ANSWER_CACHE_HEADERS = ("content-type", "content-encoding")
+
+
+class AnswerCache:
+    """
+    Bot command answers stored in SQLite, so they survive restarts and are shared by everyone
+    asking the same question. Entries are keyed by a hash of the command and the normalized
+    message, expire after the command's TTL and the least recently used ones are evicted once
+    the stored bodies exceed max_bytes.
+    All database work runs on one dedicated thread: the event loop never waits on disk I/O
+    and the connection is never shared between threads. Several workers may share the file,
+    so the stored size is read from the database inside each write rather than tracked per
+    process (hits, misses and evictions are still counted per worker).
+    """
+
+    def __init__(self, path: str, max_bytes: int, commands: Dict[str, Dict[str, Any]]):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.commands = commands
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="answer-cache")
+        self._db: Optional[sqlite3.Connection] = None
+        self.entries = 0
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize(message: str, case_sensitive: bool) -> str:
+        """Collapse whitespace (and, for questions, case and surrounding punctuation)"""
+        message = " ".join(unicodedata.normalize("NFKC", message).split())
+        if not case_sensitive:
+            message = message.casefold().strip("?!.¿¡ ")
+        return message
+
+    def make_key(self, command: str, message: Any) -> Optional[str]:
+        """Cache key of a command message, None when the message can't be cached"""
+        if not isinstance(message, str):
+            return None
+        normalized = AnswerCache.normalize(message, self.commands[command]["case_sensitive"])
+        if not normalized:
+            return None
+        return hashlib.sha256(f"{command}\0{normalized}".encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[tuple]:
+        """Return a fresh (status_code, headers, body) answer or None"""
+        entry = await asyncio.get_running_loop().run_in_executor(self._executor, self._get, key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, key: str, command: str, status_code: int, headers: Dict[str, str], body: bytes):
+        """Store an answer in the background (the caller doesn't wait for the write)"""
+        if len(body) > self.max_bytes // 16:
+            return
+        headers = {k: v for k, v in headers.items() if k.lower() in ANSWER_CACHE_HEADERS}
+        self._executor.submit(self._set, key, command, status_code, headers, body)
+
+    async def refresh(self):
+        """Reload entries and bytes from the database, which other workers also write to"""
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._refresh)
+
+    def close(self):
+        """Finish the pending writes and close the database"""
+        self._executor.submit(self._close)
+        self._executor.shutdown(wait=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": self.entries,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    # The methods below run on the cache thread
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            # Several gateway workers may share the file: WAL lets them read while one writes
+            db = sqlite3.connect(self.path, timeout=5.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, command TEXT NOT NULL, "
+                "status_code INTEGER NOT NULL, headers TEXT NOT NULL, body BLOB NOT NULL, "
+                "size INTEGER NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+            # Lets _count sum the sizes without reading the rows (and their bodies)
+            db.execute("CREATE INDEX IF NOT EXISTS answers_size ON answers (size)")
+            db.execute("DELETE FROM answers WHERE expires_at <= ?", (time.time(),))
+            db.commit()
+            self._db = db
+            self._count()
+        return self._db
+
+    def _count(self):
+        self.entries, self.total_bytes = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+
+    def _refresh(self):
+        try:
+            self._connect()
+            self._count()
+        except sqlite3.Error as e:
+            logger.warning(f"Answer cache count failed: {str(e)}")
+
+    def _get(self, key: str) -> Optional[tuple]:
+        try:
+            db = self._connect()
+            row = db.execute("SELECT status_code, headers, body, expires_at FROM answers WHERE key = ?",
+                             (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if row[3] <= now:
+                db.execute("DELETE FROM answers WHERE key = ?", (key,))
+            else:
+                db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+            db.commit()
+            return (row[0], json.loads(row[1]), row[2]) if row[3] > now else None
+        except sqlite3.Error as e:
+            logger.warning(f"Answer cache read failed: {str(e)}")
+            return None
+
+    def _set(self, key: str, command: str, status_code: int, headers: Dict[str, str], body: bytes):
+        try:
+            db = self._connect()
+            now = time.time()
+            db.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, command, status_code, json.dumps(headers), body, len(body),
+                 now + self.commands[command]["ttl"], now)
+            )
+            # Counted inside the write transaction, so it includes the other workers' answers
+            self._count()
+            if self.total_bytes > self.max_bytes:
+                self._evict(db, now)
+            db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Answer cache write failed: {str(e)}")
+
+    def _evict(self, db: sqlite3.Connection, now: float):
+        # Expired answers go first, then the least recently used ones
+        db.execute("DELETE FROM answers WHERE expires_at <= ?", (now,))
+        self._count()
+        while self.total_bytes > self.max_bytes:
+            rows = db.execute("SELECT key, size FROM answers ORDER BY last_used LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                db.execute("DELETE FROM answers WHERE key = ?", (key,))
+                self.entries -= 1
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_PATH, ANSWER_CACHE_MAX_BYTES, ANSWER_CACHE_COMMANDS)
+
+# Asynchronous bot command jobs (see CommandJobs): workers running them, jobs waiting for a
+# worker, seconds a finished job's result is kept and longest ?wait of a poll
+COMMAND_JOB_WORKERS = int(os.environ.get("COMMAND_JOB_WORKERS", "8"))
+COMMAND_JOB_MAX_QUEUE = int(os.environ.get("COMMAND_JOB_MAX_QUEUE", "200"))
+COMMAND_JOB_TTL_SECONDS = float(os.environ.get("COMMAND_JOB_TTL_SECONDS", "600"))
+COMMAND_JOB_MAX_WAIT_SECONDS = 30.0
+
+
+class CommandJob:
+    """A bot command run in the background and, once finished, its response or error"""
+
+    __slots__ = ("job_id", "command", "owner", "run", "parent_span", "status", "created_at",
+                 "finished_at", "response", "error", "done")
+
+    def __init__(self, command: str, owner: str, run, parent_span: Optional["Span"]):
+        self.job_id = base64.urlsafe_b64encode(os.urandom(18)).decode()
+        self.command = command
+        self.owner = owner
+        self.run = run
+        self.parent_span = parent_span
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.response: Optional[Response] = None
+        self.error: Optional[HTTPException] = None
+        self.done = asyncio.Event()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"job_id": self.job_id, "command": self.command, "status": self.status,
+                "created_at": datetime.fromtimestamp(self.created_at, timezone.utc).isoformat()}
+
+
+class CommandJobs:
+    """
+    Bot commands answered asynchronously: the request gets a job id right away and a fixed pool
+    of workers runs the upstream calls, so a slow answer holds neither a request slot nor the
+    client's connection. Jobs past max_queue are rejected with a 503, and results are only
+    returned to the caller that submitted them and are dropped ttl seconds after they finish.
+    """
+
+    def __init__(self, workers: int, max_queue: int, ttl: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self._jobs: Dict[str, CommandJob] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list = []
+        self.submitted = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def submit(self, command: str, headers: Dict, run) -> CommandJob:
+        """Queue run() (a coroutine function returning the command's response) as a job"""
+        self._evict(time.time())
+        if self._queue is None:
+            # Started on first use: the queue and the workers belong to the serving event loop
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+        if self._queue.qsize() >= self.max_queue:
+            self.rejected += 1
+            logger.warning(f"Command job queue is full, rejected a {command} job")
+            raise HTTPException(
+                status_code=503,
+                detail="Too many pending bot commands, try again later",
+                headers={"Retry-After": "5"}
+            )
+        job = CommandJob(command, ResponseCache.user_identity(headers), run, current_span.get())
+        self._jobs[job.job_id] = job
+        self._queue.put_nowait(job)
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: str, headers: Dict) -> Optional[CommandJob]:
+        """The caller's job with that id, None if it doesn't exist, expired or belongs to someone else"""
+        self._evict(time.time())
+        job = self._jobs.get(job_id)
+        if job is None or job.owner != ResponseCache.user_identity(headers):
+            return None
+        return job
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def snapshot(self) -> Dict[str, Any]:
+        statuses = {"queued": 0, "running": 0, "done": 0}
+        for job in self._jobs.values():
+            statuses[job.status] += 1
+        return {**statuses, "submitted": self.submitted, "rejected": self.rejected, "expired": self.expired,
+                "workers": self.workers, "max_queue": self.max_queue}
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            # Continue the trace of the request that submitted the job
+            token = current_span.set(job.parent_span)
+            try:
+                with tracer.span(f"job {job.command}", job_id=job.job_id):
+                    job.response = await job.run()
+            except HTTPException as e:
+                job.error = e
+            except Exception as e:
+                logger.exception(f"Command job {job.job_id} ({job.command}) failed")
+                job.error = HTTPException(status_code=500, detail=f"Command failed: {type(e).__name__}")
+            finally:
+                current_span.reset(token)
+                job.run = None
+                job.status = "done"
+                job.finished_at = time.time()
+                job.done.set()
+
+    def _evict(self, now: float):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self.expired += len(expired)
+
+
+command_jobs = CommandJobs(COMMAND_JOB_WORKERS, COMMAND_JOB_MAX_QUEUE, COMMAND_JOB_TTL_SECONDS)
+
+# Seconds a search result stays fresh, per search route (typeahead repeats queries within seconds)
+SEARCH_CACHE_TTLS = {
+    "search_messages": 20.0,
+    "search_files": 60.0,
+    "search_channels": 60.0,
+}
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", "2048"))
+# How long a search waits for a newer one from the same user before it is sent. 0 (the default)
+# sends it right away; a newer search still cancels it while it is in flight.
+SEARCH_DEBOUNCE_SECONDS = float(os.environ.get("SEARCH_DEBOUNCE_MS", "0")) / 1000
+# Whether a query can be answered by filtering the complete results of a shorter one (see
+# SearchCache). Off by default: it assumes the search service requires every term of a query
+# to appear as a whole word in the searched field, which hasn't been confirmed for it.
+SEARCH_PREFIX_REUSE = os.environ.get("SEARCH_PREFIX_REUSE", "false").lower() == "true"
+# Field of the results each search route matches the query against (routes without one never reuse results)
+SEARCH_MATCH_FIELDS = {
+    "search_messages": "content",
+}
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def search_words(text: Any) -> set:
+    """Normalized words of a text, used to match whole query terms"""
+    return set(WORD_PATTERN.findall(SearchCache.normalize(text))) if isinstance(text, str) else set()
+
+
+class SearchCache:
+    """
+    Bounded LRU cache of search results keyed by route, caller, filters, normalized query and page.
+    A first page holding fewer results than its limit is the complete result set of its query.
+    With SEARCH_PREFIX_REUSE, a query adding whole terms to it with the same filters is then
+    answered by keeping the results whose matched field (SEARCH_MATCH_FIELDS) has the added
+    terms as words, without asking the search service.
+    """
+
+    def __init__(self, ttls: Dict[str, float], max_entries: int, max_entry_size: int = 256 * 1024):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.max_entry_size = max_entry_size
+        # key -> (expires_at, status_code, headers, body, payload of a complete result set or None)
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        # (route, identity, filters, query) -> key of the entry holding its complete result set
+        self._complete: Dict[tuple, tuple] = {}
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Case-folded query with collapsed whitespace"""
+        return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+    @staticmethod
+    def make_key(route: str, params: Dict[str, str], identity: str) -> tuple:
+        """Build the cache key of a search whose q param is already normalized"""
+        filters = tuple(sorted((k, v) for k, v in params.items() if k not in ("q", "limit", "offset")))
+        return route, identity, filters, params.get("q"), params.get("limit"), params.get("offset", "0")
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        """Return a fresh (status_code, headers, body, X-Cache) answer for the search or None"""
+        entry = self._fresh(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1], entry[2], entry[3], "HIT"
+        refined = self._refine(key) if SEARCH_PREFIX_REUSE else None
+        if refined is not None:
+            self.prefix_hits += 1
+            return refined
+        self.misses += 1
+        return None
+
+    def set(self, key: tuple, status_code: int, headers: Dict, body: bytes):
+        """Store a successful search, noting whether it holds the complete result set of its query"""
+        ttl = self.ttls.get(key[0], 0)
+        if status_code != 200 or len(body) > self.max_entry_size or ttl <= 0:
+            return
+        route, identity, filters, query, limit, offset = key
+        payload = None
+        if (SEARCH_PREFIX_REUSE and route in SEARCH_MATCH_FIELDS and query and offset == "0"
+                and limit and limit.isdigit()):
+            try:
+                payload = json.loads(decode_content(headers.get("content-encoding"), body))
+            except ValueError:
+                payload = None
+            results = payload.get("results") if isinstance(payload, dict) else payload
+            if not isinstance(results, list) or len(results) >= int(limit):
+                payload = None
+        self._entries[key] = (time.monotonic() + ttl, status_code, headers, body, payload)
+        self._entries.move_to_end(key)
+        if payload is not None:
+            self._complete[(route, identity, filters, query)] = key
+        while len(self._entries) > self.max_entries:
+            self._drop(*self._entries.popitem(last=False))
+            self.evictions += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "prefix_hits": self.prefix_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "ttls": self.ttls,
+        }
+
+    def _fresh(self, key: tuple) -> Optional[tuple]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._drop(key, self._entries.pop(key))
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _drop(self, key: tuple, entry: tuple):
+        if entry[4] is not None and self._complete.get(key[:4]) == key:
+            del self._complete[key[:4]]
+
+    def _refine(self, key: tuple) -> Optional[tuple]:
+        """Answer a query from the complete results of the longest cached query it adds terms to"""
+        route, identity, filters, query, limit, offset = key
+        field = SEARCH_MATCH_FIELDS.get(route)
+        if not query or field is None:
+            return None
+        terms = query.split(" ")
+        for length in range(len(terms) - 1, 0, -1):
+            base_key = self._complete.get((route, identity, filters, " ".join(terms[:length])))
+            entry = self._fresh(base_key) if base_key is not None else None
+            if entry is None:
+                continue
+            payload = entry[4]
+            added = set(WORD_PATTERN.findall(" ".join(terms[length:])))
+            results = payload["results"] if isinstance(payload, dict) else payload
+            matches = [item for item in results
+                       if isinstance(item, dict) and added <= search_words(item.get(field))]
+            start = int(offset) if offset.isdigit() else 0
+            end = start + int(limit) if limit and limit.isdigit() else None
+            if isinstance(payload, dict):
+                refined = {**payload, "results": matches[start:end]}
+                if "total" in payload:
+                    refined["total"] = len(matches)
+            else:
+                refined = matches[start:end]
+            return 200, {"content-type": "application/json"}, json.dumps(refined).encode(), "PREFIX"
+        return None
+
+
+class SearchDebouncer:
+    """
+    Latest search of each search box (a user's X-Search-Client id) on each search route.
+    A newer search sets the event of the one before it, which is then dropped: before it is sent
+    if it is still in its debounce wait, or by cancelling its upstream call if that is already in flight.
+    """
+
+    def __init__(self):
+        self._latest: Dict[tuple, asyncio.Event] = {}
+        self.superseded = 0
+
+    def start(self, slot: tuple) -> asyncio.Event:
+        """Register a search, superseding the one in flight for the same slot"""
+        previous = self._latest.get(slot)
+        if previous is not None:
+            previous.set()
+            self.superseded += 1
+        self._latest[slot] = superseded = asyncio.Event()
+        return superseded
+
+    def finish(self, slot: tuple, superseded: asyncio.Event):
+        if self._latest.get(slot) is superseded:
+            del self._latest[slot]
+
+
+search_cache = SearchCache(SEARCH_CACHE_TTLS, SEARCH_CACHE_MAX_ENTRIES)
+search_debouncer = SearchDebouncer()
+# Longest X-Search-Client id accepted (useSearch sends one per hook instance)
+SEARCH_CLIENT_MAX_LENGTH = 64
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of a single service over a sliding window of its latest calls.
+    closed: calls go through and are recorded; open: calls fail fast until open_seconds pass;
+    half_open: a limited number of probes go through, one failure opens the circuit again
+    and half_open_probes successes close it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, service_name: str, window: int, min_calls: int, failure_rate: float,
+                 open_seconds: float, half_open_probes: int):
+        self.service_name = service_name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CircuitBreaker.CLOSED
+        self.opened_at = 0.0
+        self.times_opened = 0
+        # Outcomes of the latest calls (True = success) and the failures among them
+        self._outcomes: deque = deque(maxlen=window)
+        self._failures = 0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+
+    def allow(self) -> bool:
+        """Whether a call may be sent now (every allowed call must be followed by record)"""
+        if self.state == CircuitBreaker.OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                return False
+            self.state = CircuitBreaker.HALF_OPEN
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+            logger.info(f"Circuit breaker of {self.service_name} half-open, probing")
+        if self.state == CircuitBreaker.HALF_OPEN:
+            if self._probes_in_flight >= self.half_open_probes:
+                return False
+            self._probes_in_flight += 1
+        return True
+
+    def record(self, success: bool):
+        """Record the outcome of an allowed call"""
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+            if not success:
+                self._open()
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_probes:
+                self._reset(CircuitBreaker.CLOSED)
+                logger.info(f"Circuit breaker of {self.service_name} closed")
+            return
+        if self.state == CircuitBreaker.OPEN:
+            # Late result of a call sent before the circuit opened
+            return
+
+        if len(self._outcomes) == self._outcomes.maxlen and not self._outcomes[0]:
+            self._failures -= 1
+        self._outcomes.append(success)
+        if not success:
+            self._failures += 1
+            if len(self._outcomes) >= self.min_calls and self._failures / len(self._outcomes) >= self.failure_rate:
+                self._open()
+
+    def release(self):
+        """Free the probe slot of an allowed call that ended without an outcome (e.g. cancelled)"""
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def retry_after(self) -> int:
+        """Seconds until the breaker lets probes through again"""
+        return max(1, math.ceil(self.open_seconds - (time.monotonic() - self.opened_at)))
+
+    def _open(self):
+        self._reset(CircuitBreaker.OPEN)
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        logger.warning(f"Circuit breaker of {self.service_name} opened, failing fast for {self.open_seconds}s")
+
+    def _reset(self, state: str):
+        self.state = state
+        self._outcomes.clear()
+        self._failures = 0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        """State reported on /health and /services"""
+        snapshot = {
+            "state": self.state,
+            "calls_in_window": len(self._outcomes),
+            "failures_in_window": self._failures,
+            "times_opened": self.times_opened,
+        }
+        if self.state == CircuitBreaker.OPEN:
+            snapshot["retry_after"] = self.retry_after()
+        return snapshot
+
+
+class Bulkhead:
+    """
+    Concurrency limit with a bounded wait queue. Calls past max_concurrent wait up to
+    queue_timeout seconds for a free slot, calls past max_queue are rejected right away.
+    Rejections raise a 503 with Retry-After.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        """Take a slot, waiting in the queue if none is free"""
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self._reject("wait queue is full")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._reject(f"no slot freed up within {self.queue_timeout}s")
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.active += 1
+
+    def release(self):
+        """Give back a slot taken with acquire"""
+        self.active -= 1
+        self._semaphore.release()
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        logger.warning(f"Bulkhead {self.name} rejected a call: {reason}")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Too many concurrent requests for {self.name}, try again later",
+            headers={"Retry-After": str(max(1, math.ceil(self.queue_timeout)))}
+        )
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current usage reported on /services"""
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+        }
+
+
+# Token-bucket limits per route group: rate is tokens refilled per second, burst the bucket size.
+# Users are identified by their bearer token; the per-IP buckets are larger because a whole
+# campus network can share one address.
+RATE_LIMITS = {
+    "auth": {"user": (1.0, 10), "ip": (2.0, 30)},
+    "messages": {"user": (10.0, 40), "ip": (50.0, 200)},
+    "search": {"user": (5.0, 20), "ip": (20.0, 80)},
+    "commands": {"user": (0.5, 5), "ip": (2.0, 20)},
+    "jobs": {"user": (2.0, 20), "ip": (10.0, 100)},
+}
+
+# Set RATE_LIMITING_ENABLED=false to turn the limiter off (e.g. when load testing from one address)
+RATE_LIMITING_ENABLED = os.environ.get("RATE_LIMITING_ENABLED", "true").lower() != "false"
+# Proxies in front of the gateway that set X-Real-IP / append to X-Forwarded-For (the ingress);
+# 0 limits by the connection's address
+RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get("RATE_LIMIT_TRUSTED_PROXIES", "1"))
+
+# Path prefixes of each rate limited route group (the first match wins)
+RATE_LIMIT_GROUPS = [
+    ("/api/users/login", "auth"),
+    ("/api/users/register", "auth"),
+    ("/api/messages", "messages"),
+    ("/api/search", "search"),
+    # Polling a command job is cheap, it doesn't spend a command token
+    ("/api/commands/jobs", "jobs"),
+    ("/api/commands", "commands"),
+    ("/api/chatbot", "commands"),
+]
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter. Buckets live in an OrderedDict kept in last-use order,
+    so every check is O(1): idle buckets are evicted from the front and the total
+    number of buckets is capped at max_buckets.
+    """
+
+    def __init__(self, limits: Dict[str, Dict[str, Tuple[float, int]]], max_buckets: int = 50000,
+                 idle_seconds: float = 600.0):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self.idle_seconds = idle_seconds
+        # (group, kind, identity) -> [tokens, last_refill]
+        self._buckets: "OrderedDict[tuple, list]" = OrderedDict()
+        self.rejected = 0
+
+    @staticmethod
+    def route_group(path: str) -> Optional[str]:
+        """Rate limited group of a request path, None when the path isn't limited"""
+        for prefix, group in RATE_LIMIT_GROUPS:
+            if path.startswith(prefix):
+                return group
+        return None
+
+    @staticmethod
+    def client_ip(request: Request) -> str:
+        """
+        Client address as seen by the ingress: its X-Real-IP, else the X-Forwarded-For entry it
+        appended (the leftmost entries come from the client and can't be trusted)
+        """
+        peer = request.client.host if request.client else "unknown"
+        if RATE_LIMIT_TRUSTED_PROXIES <= 0:
+            return peer
+        real_ip = request.headers.get("x-real-ip")
+        if real_ip:
+            return real_ip.strip()
+        hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        if len(hops) >= RATE_LIMIT_TRUSTED_PROXIES:
+            return hops[-RATE_LIMIT_TRUSTED_PROXIES]
+        return peer
+
+    def check(self, request: Request) -> Optional[float]:
+        """Take a token for the request, returning None if allowed or the seconds to wait if not"""
+        group = RateLimiter.route_group(request.url.path)
+        if group is None:
+            return None
+        limits = self.limits[group]
+
+        retry_after = self._take((group, "ip", RateLimiter.client_ip(request)), *limits["ip"])
+        auth = request.headers.get("authorization", "")
+        if retry_after is None and auth.lower().startswith("bearer "):
+            user = hashlib.sha256(auth.encode()).hexdigest()
+            retry_after = self._take((group, "user", user), *limits["user"])
+
+        if retry_after is not None:
+            self.rejected += 1
+        return retry_after
+
+    def _take(self, key: tuple, rate: float, burst: int) -> Optional[float]:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [float(burst), now]
+            self._buckets[key] = bucket
+            self._evict(now)
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return None
+        return (1 - bucket[0]) / rate
+
+    def _evict(self, now: float):
+        # The front of the OrderedDict holds the least recently used buckets
+        while self._buckets:
+            oldest_key, (_, last) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_buckets and now - last < self.idle_seconds:
+                break
+            del self._buckets[oldest_key]
+
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+# Seconds between SSE heartbeat comments (keeps idle proxies from closing the stream)
+REALTIME_HEARTBEAT_SECONDS = 15.0
+
+# Longest streamed bot answer kept to be stored in the answer cache
+STREAM_ANSWER_MAX_BYTES = 1024 * 1024
+
+
+def sse_event(event: str, data: str) -> bytes:
+    """Encode a Server-Sent Event (multi-line data is split over several data fields)"""
+    lines = data.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return (f"event: {event}\n" + "".join(f"data: {line}\n" for line in lines) + "\n").encode()
+
+
+def wants_stream(request: Request) -> bool:
+    """Whether the client asked for a streamed answer (?stream=true or Accept: text/event-stream)"""
+    return (request.query_params.get("stream", "").lower() in ("1", "true")
+            or "text/event-stream" in request.headers.get("accept", ""))
+
+
+def wants_job(request: Request) -> bool:
+    """Whether the client asked for an asynchronous answer (?async=true or Prefer: respond-async)"""
+    return (request.query_params.get("async", "").lower() in ("1", "true")
+            or "respond-async" in request.headers.get("prefer", "").lower())
+
+# Messages service paths that create, update or delete a message of a thread
+MESSAGE_PATH_PATTERN = re.compile(r"^threads/([^/]+)/messages(?:/([^/]+))?/?$")
+
+
+class MessageHub:
+    """
+    Fan-out of message events to the WebSocket/SSE subscribers of each thread.
+    Events come from the writes going through proxy_messages, so N subscribed clients cost
+    no upstream polling at all. The hub is per process: with several workers a client only
+    sees the writes handled by its own worker.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, set] = {}
+        self._threads_of: Dict[asyncio.Queue, set] = {}
+        self.published = 0
+        self.dropped = 0
+
+    def connect(self) -> asyncio.Queue:
+        """Create the event queue of a new client connection"""
+        subscriber = asyncio.Queue(maxsize=self.queue_size)
+        self._threads_of[subscriber] = set()
+        return queue
+
+    def subscribe(self, subscriber: asyncio.Queue, thread_id: str):
+        self._subscribers.setdefault(thread_id, set()).add(subscriber)
+        self._threads_of[subscriber].add(thread_id)
+
+    def unsubscribe(self, subscriber: asyncio.Queue, thread_id: str):
+        subscribers = self._subscribers.get(thread_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[thread_id]
+        self._threads_of.get(subscriber, set()).discard(thread_id)
+
+    def disconnect(self, subscriber: asyncio.Queue):
+        """Drop every subscription of a closed connection"""
+        for thread_id in list(self._threads_of.get(subscriber, ())):
+            self.unsubscribe(subscriber, thread_id)
+        self._threads_of.pop(subscriber, None)
+
+    def publish_write(self, path: str, method: str, body: bytes):
+        """Publish the event of a successful message write (path is relative to the messages service)"""
+        match = MESSAGE_PATH_PATTERN.match(path)
+        if match is None:
+            return
+        thread_id, message_id = match.groups()
+        # Only parse the upstream body when someone is listening
+        if thread_id not in self._subscribers:
+            return
+
+        if method == "POST" and message_id is None:
+            event_type = "message.created"
+        elif method in ["PUT", "PATCH"] and message_id is not None:
+            event_type = "message.updated"
+        elif method == "DELETE" and message_id is not None:
+            event_type = "message.deleted"
+        else:
+            return
+
+        try:
+            message = json.loads(body) if body else None
+        except ValueError:
+            message = None
+        if message_id is None and isinstance(message, dict) and message.get("id") is not None:
+            # A created message's id is only known from the service's answer
+            message_id = str(message["id"])
+
+        # Encoded once, every subscriber gets the same string
+        payload = json.dumps({"type": event_type, "thread_id": thread_id,
+                              "message_id": message_id, "message": message})
+        for subscriber in self._subscribers[thread_id]:
+            if subscriber.full():
+                # Slow consumer: drop its oldest event rather than blocking the publisher
+                subscriber.get_nowait()
+                self.dropped += 1
+            subscriber.put_nowait(payload)
+        self.published += 1
+
+
+message_hub = MessageHub()
+
+# Recent message index settings: each thread keeps the messages of the last MESSAGE_INDEX_WINDOW_SECONDS,
+# at most MESSAGE_INDEX_MAX_PER_THREAD of them and MESSAGE_INDEX_MAX_MESSAGES overall
+MESSAGE_INDEX_WINDOW_SECONDS = float(os.environ.get("MESSAGE_INDEX_WINDOW_SECONDS", str(24 * 3600)))
+MESSAGE_INDEX_MAX_PER_THREAD = int(os.environ.get("MESSAGE_INDEX_MAX_PER_THREAD", "500"))
+MESSAGE_INDEX_MAX_MESSAGES = int(os.environ.get("MESSAGE_INDEX_MAX_MESSAGES", "50000"))
+# Messages with longer content aren't indexed
+MESSAGE_INDEX_MAX_CONTENT = 4096
+# Shortest query term matched as a word prefix (shorter ones must be whole words)
+MESSAGE_INDEX_MIN_PREFIX = 2
+# Threads whose last message pages are remembered (by digest) so rereading an unchanged page costs no parsing,
+# and pages remembered per thread
+MESSAGE_INDEX_PAGE_THREADS = 4096
+MESSAGE_INDEX_PAGES_PER_THREAD = 32
+# Search params the index can answer (author_id is the message's user_id)
+MESSAGE_INDEX_FILTERS = {"thread_id": "thread_id", "author_id": "user_id", "message_id": "id"}
+# Field of an indexed message filling each field of a search service result (others are taken by name)
+MESSAGE_RESULT_FIELDS = {"message_id": "id", "author_id": "user_id"}
+# Searches whose total in the search service is remembered for local answers
+MESSAGE_INDEX_MAX_TOTALS = 4096
+
+
+class MessageIndex:
+    """
+    In-memory inverted index of the recent messages seen going through proxy_messages
+    (pages read, messages posted, edited and deleted), used to answer message searches
+    without the search service. Query terms match words starting with them and results
+    come newest first. Messages carry no channel, so the sliding window is kept per thread.
+    A caller is only shown the threads its token has read or written through the gateway,
+    and local answers take the payload and result shape of the search service's last answer.
+    """
+
+    def __init__(self, window: float, max_per_thread: int, max_messages: int):
+        self.window = window
+        self.max_per_thread = max_per_thread
+        self.max_messages = max_messages
+        # message id -> (timestamp, thread_id, message, words), oldest indexed first
+        self._messages: "OrderedDict[str, tuple]" = OrderedDict()
+        # thread_id -> {message id: timestamp}
+        self._threads: Dict[str, Dict[str, float]] = {}
+        # word -> ids of the messages containing it, and every word in sorted order for prefix lookups
+        self._postings: Dict[str, set] = {}
+        self._words: list = []
+        # thread_id -> identities (see ResponseCache.user_identity) the messages service let read it
+        self._readers: Dict[str, set] = {}
+        # thread_id -> digests of the pages of it already indexed, least recently read thread first
+        self._pages: "OrderedDict[str, set]" = OrderedDict()
+        # Shape of the search service's answers, learned from its last one: "list" for a bare list
+        # of results, otherwise the keys of its object in order (None until it has answered)
+        self.payload_shape: Any = None
+        # Fields of the search service's results, learned from the last answer that had any
+        self.result_fields: Optional[tuple] = None
+        # search (see total_key) -> (its total in the search service, epoch seconds it was answered at)
+        self._totals: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._last_sweep = time.time()
+        self.local_answers = 0
+        self.merged_answers = 0
+        self.pages_skipped = 0
+
+    @staticmethod
+    def words(text: str) -> list:
+        return WORD_PATTERN.findall(SearchCache.normalize(text))
+
+    @staticmethod
+    def timestamp(message: Dict[str, Any]) -> float:
+        """Creation time of a message in epoch seconds (now when it has none)"""
+        created_at = message.get("created_at")
+        if isinstance(created_at, str):
+            try:
+                created = datetime.fromisoformat(created_at)
+            except ValueError:
+                return time.time()
+            if created.tzinfo is None:
+                created = created.replace(tzinfo=timezone.utc)
+            return created.timestamp()
+        return time.time()
+
+    def add(self, thread_id: str, message: Any):
+        """Index a message (replacing the indexed version of it) if it is inside the window"""
+        if not isinstance(message, dict):
+            return
+        message_id, content = message.get("id"), message.get("content")
+        if message_id is None or not isinstance(content, str) or len(content) > MESSAGE_INDEX_MAX_CONTENT:
+            return
+        message_id = str(message_id)
+        now = time.time()
+        seen_at = MessageIndex.timestamp(message)
+        if seen_at < now - self.window:
+            return
+        entry = self._messages.get(message_id)
+        if entry is not None and entry[1] == thread_id and entry[2].get("content") == content:
+            # Same content: keep its words instead of tokenizing it again
+            self._messages[message_id] = (entry[0], thread_id,
+                                          {**message, "thread_id": message.get("thread_id", thread_id)}, entry[3])
+            return
+        self.remove(message_id)
+        words = frozenset(MessageIndex.words(content))
+        self._messages[message_id] = (seen_at, thread_id, {**message, "thread_id": message.get("thread_id", thread_id)},
+                                      words)
+        for word in words:
+            postings = self._postings.get(word)
+            if postings is None:
+                self._postings[word] = postings = set()
+                insort(self._words, word)
+            postings.add(message_id)
+        thread = self._threads.setdefault(thread_id, {})
+        thread[message_id] = seen_at
+        if len(thread) > self.max_per_thread:
+            self.remove(min(thread, key=thread.get))
+        while len(self._messages) > self.max_messages:
+            self.remove(next(iter(self._messages)))
+        if now - self._last_sweep > 60:
+            self._sweep(now)
+
+    def grant(self, thread_id: str, identity: str):
+        """Record that the messages service let a caller read or write a thread"""
+        self._readers.setdefault(thread_id, set()).add(identity)
+
+    def add_page(self, thread_id: str, response: "UpstreamResponse"):
+        """
+        Index a page of messages returned by the messages service. A page already indexed byte for byte
+        (as the service sent it, before decoding) is skipped without parsing it.
+        """
+        digest = hashlib.blake2b(response.content, digest_size=16).digest()
+        pages = self._pages.get(thread_id)
+        if pages is not None and digest in pages:
+            self._pages.move_to_end(thread_id)
+            self.pages_skipped += 1
+            return
+        try:
+            page = json.loads(response.body)
+        except ValueError:
+            return
+        if isinstance(page, dict):
+            page = page.get("items", page.get("messages"))
+        if isinstance(page, list):
+            for message in page:
+                self.add(thread_id, message)
+        # Recorded after indexing: a message of the thread replaced or removed meanwhile forgets its pages
+        pages = self._pages.setdefault(thread_id, set())
+        if len(pages) >= MESSAGE_INDEX_PAGES_PER_THREAD:
+            pages.clear()
+        pages.add(digest)
+        self._pages.move_to_end(thread_id)
+        if len(self._pages) > MESSAGE_INDEX_PAGE_THREADS:
+            self._pages.popitem(last=False)
+
+    def remove(self, message_id: str):
+        entry = self._messages.pop(message_id, None)
+        if entry is None:
+            return
+        _, thread_id, _, words = entry
+        # The pages read before no longer match what is indexed
+        self._pages.pop(thread_id, None)
+        for word in words:
+            postings = self._postings[word]
+            postings.discard(message_id)
+            if not postings:
+                del self._postings[word]
+                del self._words[bisect_left(self._words, word)]
+        thread = self._threads[thread_id]
+        del thread[message_id]
+        if not thread:
+            del self._threads[thread_id]
+
+    def search(self, params: Dict[str, str], count: int, identity: str,
+               since: Optional[float] = None) -> Optional[Tuple[list, int, int]]:
+        """
+        Up to count messages matching a search, newest first (ties by id), the number of matches and
+        how many of them were created after since, or None when the search has params the index can't
+        evaluate. Only the messages inside the window of the threads the caller has read are searched.
+        """
+        if any(key not in ("q", "limit", "offset") and key not in MESSAGE_INDEX_FILTERS for key in params):
+            return None
+        terms = MessageIndex.words(params.get("q", ""))
+        if not terms:
+            return None
+        matches = None
+        for term in terms:
+            if len(term) < MESSAGE_INDEX_MIN_PREFIX:
+                # As a prefix a single character would match a good part of the index
+                term_matches = set(self._postings.get(term, ()))
+            else:
+                term_matches = set()
+                position = bisect_left(self._words, term)
+                while position < len(self._words) and self._words[position].startswith(term):
+                    term_matches |= self._postings[self._words[position]]
+                    position += 1
+            matches = term_matches if matches is None else matches & term_matches
+            if not matches:
+                return [], 0, 0
+        oldest = time.time() - self.window
+        filters = [(field, params[param]) for param, field in MESSAGE_INDEX_FILTERS.items() if param in params]
+        results = []
+        for message_id in matches:
+            seen_at, thread_id, message, _ = self._messages[message_id]
+            if (seen_at >= oldest and identity in self._readers.get(thread_id, ())
+                    and all(str(message.get(field)) == value for field, value in filters)):
+                results.append((seen_at, message_id, message))
+        newest = heapq.nlargest(count, results, key=lambda result: (result[0], result[1]))
+        newer = 0 if since is None else sum(1 for result in results if result[0] > since)
+        return [message for _, _, message in newest], len(results), newer
+
+    @staticmethod
+    def total_key(params: Dict[str, str], identity: str) -> tuple:
+        """Key of a search regardless of its page"""
+        return (identity, tuple(sorted((key, SearchCache.normalize(value) if key == "q" else value)
+                                       for key, value in params.items() if key not in ("limit", "offset"))))
+
+    def known_total(self, key: tuple) -> Optional[tuple]:
+        """(total, answered at) of the search service's last answer to a search, if remembered"""
+        return self._totals.get(key)
+
+    def remember_total(self, key: tuple, total: int):
+        """Remember the total the search service (plus the local hits merged into it) gave a search"""
+        self._totals[key] = (total, time.time())
+        self._totals.move_to_end(key)
+        if len(self._totals) > MESSAGE_INDEX_MAX_TOTALS:
+            self._totals.popitem(last=False)
+
+    def learn_shape(self, payload: Any):
+        """Remember the shape of an answer of the search service and of its results"""
+        if isinstance(payload, list):
+            self.payload_shape, results = "list", payload
+        elif isinstance(payload, dict) and isinstance(payload.get("results"), list):
+            self.payload_shape, results = tuple(payload), payload["results"]
+        else:
+            return
+        if results and isinstance(results[0], dict):
+            self.result_fields = tuple(results[0])
+
+    def to_result(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """An indexed message as a search service result, None if its fields are unknown or can't be filled"""
+        if self.result_fields is None:
+            return None
+        result = {}
+        for field in self.result_fields:
+            source = MESSAGE_RESULT_FIELDS.get(field, field)
+            if source not in message:
+                return None
+            result[field] = message[source]
+        return result
+
+    def render(self, page: list, total: Optional[int], limit: int, offset: int) -> Optional[Any]:
+        """
+        A page of local results in the search service's shape, None if its shape is unknown or can't be
+        filled (a shape with a total needs the search's total in the search service)
+        """
+        if self.payload_shape is None:
+            return None
+        results = [self.to_result(message) for message in page]
+        if None in results:
+            return None
+        if self.payload_shape == "list":
+            return results
+        values = {"results": results, "limit": limit, "offset": offset}
+        if total is not None:
+            values["total"] = values["count"] = total
+        if not values.keys() >= set(self.payload_shape):
+            return None
+        return {key: values[key] for key in self.payload_shape}
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "messages": len(self._messages),
+            "threads": len(self._threads),
+            "words": len(self._words),
+            "readable_threads": len(self._readers),
+            "pages_skipped": self.pages_skipped,
+            "window_seconds": self.window,
+            "local_answers": self.local_answers,
+            "merged_answers": self.merged_answers,
+        }
+
+    def _sweep(self, now: float):
+        """Drop the messages that left the window"""
+        self._last_sweep = now
+        oldest = now - self.window
+        for message_id in [message_id for message_id, entry in self._messages.items() if entry[0] < oldest]:
+            self.remove(message_id)
+        for thread_id in [thread_id for thread_id in self._readers if thread_id not in self._threads]:
+            del self._readers[thread_id]
+
+
+message_index = MessageIndex(MESSAGE_INDEX_WINDOW_SECONDS, MESSAGE_INDEX_MAX_PER_THREAD, MESSAGE_INDEX_MAX_MESSAGES)
+
+# Presence table settings: a user without heartbeat for PRESENCE_TTL_SECONDS is reported offline
+# and forgotten after PRESENCE_FORGET_SECONDS; heartbeats are flushed upstream every PRESENCE_FLUSH_SECONDS
+PRESENCE_TTL_SECONDS = 90.0
+PRESENCE_FORGET_SECONDS = 3600.0
+PRESENCE_FLUSH_SECONDS = 5.0
+# Most heartbeats sent at once by a flush, so it doesn't take over the presence service's bulkhead
+PRESENCE_FLUSH_CONCURRENCY = 8
+
+
+class PresenceTable:
+    """
+    In-gateway view of user presence. Heartbeats (PATCH) update the table in O(1) and are
+    queued for the presence service; the flush loop sends only the latest change of each
+    user per interval, and a heartbeat the service rejects takes its user out of the table.
+    Listing and stats are answered from the table.
+    """
+
+    def __init__(self):
+        # user_id -> (last_seen epoch, record as returned to clients)
+        self._entries: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        # user_id -> (latest PATCH body, authorization header) waiting for the next flush
+        self._pending: Dict[str, Tuple[Dict[str, Any], str]] = {}
+        self.seeded = False
+        self.heartbeats = 0
+        self.flushed = 0
+        self.flush_failures = 0
+
+    def heartbeat(self, user_id: str, body: Optional[Dict[str, Any]], authorization: str = "") -> Dict[str, Any]:
+        """Record a heartbeat and queue it for the presence service"""
+        self.heartbeats += 1
+        self._pending[user_id] = (body or {}, authorization)
+        return self.record(user_id, body)
+
+    def record(self, user_id: str, fields: Optional[Dict[str, Any]], seen_at: Optional[float] = None) -> Dict[str, Any]:
+        """Update the record of a user without notifying the presence service"""
+        seen_at = seen_at or time.time()
+        previous = self._entries.get(user_id, (0.0, {}))[1]
+        record = {**previous, **(fields or {}), "userId": user_id,
+                  "last_seen": datetime.fromtimestamp(seen_at, timezone.utc).isoformat()}
+        record.setdefault("status", "online")
+        self._entries[user_id] = (seen_at, record)
+        return record
+
+    def remove(self, user_id: str):
+        self._entries.pop(user_id, None)
+        self._pending.pop(user_id, None)
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(user_id)
+        return self._current(*entry) if entry is not None else None
+
+    def list(self, status: Optional[str] = None) -> list:
+        records = [self._current(*entry) for entry in self._entries.values()]
+        if status:
+            records = [record for record in records if record["status"] == status]
+        return records
+
+    def stats(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {"online": 0, "offline": 0}
+        for entry in self._entries.values():
+            status = self._current(*entry)["status"]
+            counts[status] = counts.get(status, 0) + 1
+        counts["total"] = len(self._entries)
+        return counts
+
+    def _current(self, seen_at: float, record: Dict[str, Any]) -> Dict[str, Any]:
+        if time.time() - seen_at > PRESENCE_TTL_SECONDS and record["status"] != "offline":
+            return {**record, "status": "offline"}
+        return record
+
+    def seed(self, records: Any):
+        """Load the presence service's list once, so a fresh pod doesn't start with an empty table"""
+        self.seeded = True
+        if isinstance(records, dict):
+            records = records.get("users") or records.get("items") or []
+        if not isinstance(records, list):
+            return
+        for record in records:
+            if isinstance(record, dict):
+                user_id = record.get("userId") or record.get("user_id")
+                if user_id and str(user_id) not in self._entries:
+                    self.record(str(user_id), record)
+
+    async def flush(self):
+        """Send the pending heartbeats upstream, one PATCH per user carrying its latest change"""
+        now = time.time()
+        for user_id in [user_id for user_id, (seen_at, _) in self._entries.items()
+                        if now - seen_at > PRESENCE_FORGET_SECONDS]:
+            del self._entries[user_id]
+
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        semaphore = asyncio.Semaphore(PRESENCE_FLUSH_CONCURRENCY)
+
+        async def send(user_id: str, body: Dict[str, Any], authorization: str) -> bool:
+            headers = {"authorization": authorization} if authorization else {}
+            try:
+                async with semaphore:
+                    status_code, _, content = await GatewayService.fetch(
+                        "presence", f"/api/v1.0.0/presence/{user_id}", "PATCH", headers, body)
+            except HTTPException as e:
+                status_code, detail = e.status_code, e.detail
+            else:
+                if status_code < 300:
+                    return True
+                detail = content[:200].decode("utf-8", errors="replace")
+            self.flush_failures += 1
+            if status_code == 429 or status_code >= 500:
+                logger.warning(f"Presence flush for {user_id} failed ({status_code}), retrying: {detail}")
+                # Retry on the next flush unless a newer heartbeat arrived meanwhile
+                self._pending.setdefault(user_id, (body, authorization))
+            else:
+                logger.warning(f"Presence service rejected the heartbeat of {user_id} ({status_code}): {detail}")
+                # The user was shown online on the strength of this heartbeat; a newer one pending gets its own say
+                if user_id not in self._pending:
+                    self._entries.pop(user_id, None)
+            return False
+
+        sent = await asyncio.gather(*(send(user_id, body, auth) for user_id, (body, auth) in pending.items()))
+        self.flushed += sum(sent)
+
+    async def run_flush_loop(self):
+        """Flush every PRESENCE_FLUSH_SECONDS until cancelled"""
+        while True:
+            await asyncio.sleep(PRESENCE_FLUSH_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Presence flush failed: {str(e)}", exc_info=True)
+
+
+presence_table = PresenceTable()
+
+# Histogram bucket upper bounds (+Inf is implicit). Latencies go up to the 300s chatbot timeout.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram rendered in the Prometheus text format.
+    observe only bumps preallocated counters: no lock is needed since the event loop
+    is single-threaded, and nothing is allocated on the request path.
+    """
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        # counts[i] holds the observations <= bounds[i] (and > bounds[i - 1]), the last one the overflow
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, name: str, labels: str, lines: list):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {cumulative}")
+
+
+class RouteMetrics:
+    """Counters of one gateway route (method + path template)"""
+
+    __slots__ = ("statuses", "latency", "request_size", "response_size")
+
+    def __init__(self):
+        self.statuses: Dict[int, int] = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.request_size = Histogram(SIZE_BUCKETS)
+        self.response_size = Histogram(SIZE_BUCKETS)
+
+
+class UpstreamMetrics:
+    """Counters of the calls made to one service"""
+
+    __slots__ = ("in_flight", "statuses", "connect", "ttfb", "total", "response_size")
+
+    def __init__(self):
+        self.in_flight = 0
+        # Upstream status code, or "error" when no response came back
+        self.statuses: Dict[Any, int] = {}
+        self.connect = Histogram(LATENCY_BUCKETS)
+        self.ttfb = Histogram(LATENCY_BUCKETS)
+        self.total = Histogram(LATENCY_BUCKETS)
+        self.response_size = Histogram(SIZE_BUCKETS)
+
+
+class UpstreamTimer:
+    """
+    Connect and time-to-first-byte timings of one upstream call, taken from the httpx trace
+    extension. connect stays None when the call reused a pooled keep-alive connection.
+    """
+
+    __slots__ = ("started", "connect_started", "connect", "ttfb")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.connect_started = 0.0
+        self.connect: Optional[float] = None
+        self.ttfb: Optional[float] = None
+
+    async def trace(self, event: str, info: Dict[str, Any]):
+        if event == "connection.connect_tcp.started":
+            self.connect_started = time.perf_counter()
+        elif event == "connection.connect_tcp.complete" or event == "connection.start_tls.complete":
+            self.connect = time.perf_counter() - self.connect_started
+        elif event.endswith(".receive_response_headers.complete"):
+            self.ttfb = time.perf_counter() - self.started
+
+
+class GatewayMetrics:
+    """
+    Request metrics exposed on /metrics: counts, status codes, latency and payload size
+    per gateway route, connect/TTFB/total timings per service and in-flight gauges.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.routes: Dict[Tuple[str, str], RouteMetrics] = {}
+        self.upstreams: Dict[str, UpstreamMetrics] = {}
+
+    def upstream(self, service_name: str) -> UpstreamMetrics:
+        metrics = self.upstreams.get(service_name)
+        if metrics is None:
+            metrics = self.upstreams[service_name] = UpstreamMetrics()
+        return metrics
+
+    def observe_request(self, request: Request, status_code: int, duration: float, response: Optional[Response]):
+        """Record a request answered by the gateway, labelled with the template of the matched route"""
+        route = request.scope.get("route")
+        key = (request.method, route.path if route is not None else "unmatched")
+        metrics = self.routes.get(key)
+        if metrics is None:
+            metrics = self.routes[key] = RouteMetrics()
+        metrics.statuses[status_code] = metrics.statuses.get(status_code, 0) + 1
+        metrics.latency.observe(duration)
+        request_size = request.headers.get("content-length")
+        if request_size is not None and request_size.isdigit():
+            metrics.request_size.observe(int(request_size))
+        # Streamed responses have no content-length and aren't measured here (see the upstream sizes)
+        response_size = response.headers.get("content-length") if response is not None else None
+        if response_size is not None and response_size.isdigit():
+            metrics.response_size.observe(int(response_size))
+
+    def observe_upstream(self, metrics: UpstreamMetrics, timer: UpstreamTimer, status: Any, size: Optional[int] = None):
+        """Record a finished upstream call"""
+        metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+        if timer.connect is not None:
+            metrics.connect.observe(timer.connect)
+        if timer.ttfb is not None:
+            metrics.ttfb.observe(timer.ttfb)
+        metrics.total.observe(time.perf_counter() - timer.started)
+        if size is not None:
+            metrics.response_size.observe(size)
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = [
+            "# HELP gateway_requests_in_flight Requests being handled by the gateway",
+            "# TYPE gateway_requests_in_flight gauge",
+            f"gateway_requests_in_flight {self.in_flight}",
+            "# HELP gateway_requests_total Requests answered per route and status code",
+            "# TYPE gateway_requests_total counter",
+        ]
+        routes = sorted(self.routes.items())
+        for (method, route), metrics in routes:
+            for status_code, count in sorted(metrics.statuses.items()):
+                lines.append(f'gateway_requests_total{{method="{method}",route="{route}",status="{status_code}"}} {count}')
+        for name, attribute, help_text in (
+            ("gateway_request_duration_seconds", "latency", "Time until the response headers were sent"),
+            ("gateway_request_size_bytes", "request_size", "Request body sizes (from content-length)"),
+            ("gateway_response_size_bytes", "response_size", "Response body sizes (from content-length)"),
+        ):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for (method, route), metrics in routes:
+                getattr(metrics, attribute).render(name, f'method="{method}",route="{route}"', lines)
+
+        upstreams = sorted(self.upstreams.items())
+        lines.append("# HELP gateway_upstream_in_flight Calls in flight per service")
+        lines.append("# TYPE gateway_upstream_in_flight gauge")
+        for service_name, metrics in upstreams:
+            lines.append(f'gateway_upstream_in_flight{{service="{service_name}"}} {metrics.in_flight}')
+        lines.append("# HELP gateway_upstream_requests_total Calls per service and upstream status code")
+        lines.append("# TYPE gateway_upstream_requests_total counter")
+        for service_name, metrics in upstreams:
+            for status, count in sorted(metrics.statuses.items(), key=lambda item: str(item[0])):
+                lines.append(f'gateway_upstream_requests_total{{service="{service_name}",status="{status}"}} {count}')
+        for name, attribute, help_text in (
+            ("gateway_upstream_connect_seconds", "connect", "TCP/TLS connect time of new upstream connections"),
+            ("gateway_upstream_ttfb_seconds", "ttfb", "Time until the upstream response headers arrived"),
+            ("gateway_upstream_duration_seconds", "total", "Total upstream call time, body included"),
+            ("gateway_upstream_response_size_bytes", "response_size", "Upstream response body sizes"),
+        ):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for service_name, metrics in upstreams:
+                getattr(metrics, attribute).render(name, f'service="{service_name}"', lines)
+        return "\n".join(lines) + "\n"
+
+
+gateway_metrics = GatewayMetrics()
+
+# Tracing: TRACE_EXPORTER=file appends the spans of sampled requests to TRACE_EXPORT_PATH.
+# Traces started by the gateway are sampled with probability TRACE_SAMPLE_RATE, traces coming
+# in with a traceparent keep the caller's sampling decision.
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "none").lower()
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "traces.jsonl")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0"))
+
+# W3C trace context: version-trace_id-parent_id-flags
+TRACEPARENT_PATTERN = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class RequestTrace:
+    """Finished spans of one gateway request and the time spent in each service (for Server-Timing)"""
+
+    __slots__ = ("trace_id", "sampled", "spans", "service_ms", "finished")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans: list = []
+        self.service_ms: Dict[str, float] = {}
+        self.finished = False
+
+
+class Span:
+    """A timed operation of a request trace. Spans without a trace (background work) record nothing."""
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "service", "attributes", "start", "end", "error")
+
+    def __init__(self, trace: Optional[RequestTrace], name: str, parent_id: Optional[str],
+                 service: Optional[str] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.trace = trace
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.service = service
+        self.attributes = attributes or {}
+        self.start = time.time_ns()
+        self.end = 0
+        self.error: Optional[str] = None
+
+    def traceparent(self) -> Optional[str]:
+        """traceparent header making this span the parent of the upstream's spans"""
+        if self.trace is None:
+            return None
+        return f"00-{self.trace.trace_id}-{self.span_id}-{'01' if self.trace.sampled else '00'}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """OTLP-like JSON representation written by the exporters"""
+        return {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start,
+            "endTimeUnixNano": self.end,
+            "attributes": {**self.attributes, **({"service": self.service} if self.service else {})},
+            "status": {"code": "ERROR", "message": self.error} if self.error else {"code": "OK"},
+        }
+
+
+class SpanExporter:
+    """Receives the finished spans of sampled requests. Subclass it and set tracer.exporter to plug one in."""
+
+    def export(self, spans: list):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class FileSpanExporter(SpanExporter):
+    """Appends spans as JSON lines to a file from a background thread, standing in for an OTLP collector"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, spans: list):
+        self._queue.put(spans)
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def _write(self):
+        with open(self.path, "a") as file:
+            while True:
+                spans = self._queue.get()
+                if spans is None:
+                    return
+                file.writelines(json.dumps(span.to_dict(), separators=(",", ":")) + "\n" for span in spans)
+                if self._queue.empty():
+                    file.flush()
+
+
+# Span the code running now belongs to; the middleware sets the root span of each request
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """
+    Minimal W3C trace-context tracer: continues or starts a trace per request, times spans
+    around the gateway's own work and its upstream calls, and hands sampled traces to the exporter.
+    """
+
+    def __init__(self, exporter: Optional[SpanExporter] = None):
+        self.exporter = exporter
+
+    def start_trace(self, traceparent: Optional[str]) -> Span:
+        """Root span of a request, child of the caller's span when it sent a valid traceparent"""
+        match = TRACEPARENT_PATTERN.match(traceparent or "")
+        if match and match.group(1) != "0" * 32:
+            trace = RequestTrace(match.group(1), int(match.group(3), 16) & 1 == 1)
+            parent_id = match.group(2)
+        else:
+            trace = RequestTrace(f"{random.getrandbits(128):032x}", random.random() < TRACE_SAMPLE_RATE)
+            parent_id = None
+        return Span(trace, "request", parent_id)
+
+    def start_span(self, name: str, service: Optional[str] = None, **attributes) -> Span:
+        """Child of the current span (end it with end_span)"""
+        parent = current_span.get()
+        if parent is None:
+            return Span(None, name, None, service, attributes)
+        return Span(parent.trace, name, parent.span_id, service, attributes)
+
+    def end_span(self, span: Span, error: Optional[BaseException] = None):
+        trace = span.trace
+        if trace is None or span.end:
+            return
+        span.end = time.time_ns()
+        if error is not None:
+            span.error = type(error).__name__
+        if span.service:
+            trace.service_ms[span.service] = trace.service_ms.get(span.service, 0.0) + (span.end - span.start) / 1e6
+        if not trace.sampled or self.exporter is None:
+            return
+        if trace.finished:
+            # Streamed responses finish their upstream span after the request trace was exported
+            self.exporter.export([span])
+        else:
+            trace.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, service: Optional[str] = None, **attributes):
+        """Time a block as a child span, which is the current span inside the block"""
+        span = self.start_span(name, service, **attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            self.end_span(span, e)
+            raise
+        finally:
+            current_span.reset(token)
+            self.end_span(span)
+
+    def finish_trace(self, root: Span, status_code: int) -> str:
+        """End the root span, export the trace and return the Server-Timing header value"""
+        trace = root.trace
+        root.attributes["http.status_code"] = status_code
+        if status_code >= 500:
+            root.error = str(status_code)
+        self.end_span(root)
+        trace.finished = True
+        if trace.spans:
+            self.exporter.export(trace.spans)
+        server_timing = [f"total;dur={(root.end - root.start) / 1e6:.1f}"]
+        server_timing.extend(f"{service};dur={ms:.1f}" for service, ms in trace.service_ms.items())
+        return ", ".join(server_timing)
+
+    def shutdown(self):
+        if self.exporter is not None:
+            self.exporter.shutdown()
+
+
+tracer = Tracer(FileSpanExporter(TRACE_EXPORT_PATH) if TRACE_EXPORTER == "file" else None)
+
+
+# Response compression: bodies of at least COMPRESSION_MIN_SIZE bytes with a compressible content
+# type are compressed with the best encoding the client accepts (brotli level 4 is about as fast
+# as gzip level 6 and compresses JSON better)
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVELS = {"br": 4, "gzip": 6}
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "application/xml", "image/svg+xml")
+
+# Encodings asked from the services: the ones decode_content can undo
+UPSTREAM_ACCEPT_ENCODING = "br, gzip, deflate" if brotli is not None else "gzip, deflate"
+
+
+def accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """Content codings of an Accept-Encoding header with their q-values"""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    return accepted
+
+
+def accepts_encoding(accept_encoding: str, coding: str) -> bool:
+    """Whether a client sending accept_encoding can take a body encoded with coding"""
+    accepted = accepted_encodings(accept_encoding)
+    return accepted.get(coding.lower(), accepted.get("*", 0.0)) > 0
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Best encoding the gateway can compress with for this client (brotli first), None for identity"""
+    accepted = accepted_encodings(accept_encoding)
+    best, best_quality = None, 0.0
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+        quality = accepted.get(coding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def vary_on_accept_encoding(headers: MutableHeaders):
+    """Add Accept-Encoding to the Vary header (once)"""
+    if "accept-encoding" not in headers.get("vary", "").lower():
+        headers.add_vary_header("Accept-Encoding")
+
+
+def compress_content(coding: str, content: bytes) -> bytes:
+    if coding == "br":
+        return brotli.compress(content, quality=COMPRESSION_LEVELS["br"])
+    return gzip.compress(content, compresslevel=COMPRESSION_LEVELS["gzip"], mtime=0)
+
+
+def decode_content(encoding: Optional[str], content: bytes) -> bytes:
+    """Undo a content-encoding (bodies in encodings the gateway doesn't know are returned unchanged)"""
+    encoding = (encoding or "").strip().lower()
+    if encoding == "gzip":
+        return gzip.decompress(content)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            # Some servers send raw deflate without the zlib wrapper
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    if encoding == "br" and brotli is not None:
+        return brotli.decompress(content)
+    return content
+
+
+class UpstreamResponse(Response):
+    """
+    Upstream body in the content-encoding the service sent it with (headers["content-encoding"]).
+    Clients accepting that encoding get the bytes as they came, without decompressing and
+    recompressing; other clients, and code reading .body, get the decoded body, decoded once on first use.
+    """
+
+    def __init__(self, status_code: int, headers: Dict[str, str], content: bytes):
+        self.status_code = status_code
+        self.background = None
+        self.encoding = headers.get("content-encoding")
+        self.content = content
+        self._decoded = None if self.encoding else content
+        # content-length is only known once the encoding to send is picked (see __call__)
+        self.raw_headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()
+                            if k.lower() != "content-length"]
+
+    @property
+    def body(self) -> bytes:
+        if self._decoded is None:
+            self._decoded = decode_content(self.encoding, self.content)
+        return self._decoded
+
+    async def __call__(self, scope, receive, send):
+        accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+        headers = MutableHeaders(raw=list(self.raw_headers))
+        if self.encoding and not accepts_encoding(accept_encoding, self.encoding):
+            body = self.body
+            del headers["content-encoding"]
+        else:
+            body = self.content
+        if self.encoding:
+            vary_on_accept_encoding(headers)
+        if not (self.status_code < 200 or self.status_code in (204, 304)):
+            headers["content-length"] = str(len(body))
+        await send({"type": "http.response.start", "status": self.status_code, "headers": headers.raw})
+        await send({"type": "http.response.body", "body": body})
+
+
+class CompressionMiddleware:
+    """
+    Compress response bodies with brotli or gzip, negotiated from Accept-Encoding.
+    Only single-message bodies are compressed: streamed responses (file relays, SSE) and bodies
+    that already have a content-encoding (upstream pass-through) are sent unchanged.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        coding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_compressed(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                # Held back until the first body message shows whether the body is complete
+                start_message = message
+                return
+            if start_message is not None and message["type"] == "http.response.body":
+                start, start_message = start_message, None
+                headers = MutableHeaders(raw=start["headers"])
+                body = message.get("body", b"")
+                if headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES) and "content-encoding" not in headers:
+                    vary_on_accept_encoding(headers)
+                    if not message.get("more_body", False) and len(body) >= COMPRESSION_MIN_SIZE:
+                        body = compress_content(coding, body)
+                        headers["content-encoding"] = coding
+                        headers["content-length"] = str(len(body))
+                        message = {**message, "body": body}
+                await send(start)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+
+# Added before the logging middleware below, so it runs inside it and the access log and
+# metrics see the compressed sizes
+app.add_middleware(CompressionMiddleware)
+
+
 class GatewayService:
     """Service class to handle API gateway logic"""
-    
+
+    # One pooled keep-alive client per service, created lazily inside the event loop
+    _clients: Dict[str, httpx.AsyncClient] = {}
+    # Upstream GETs currently in flight, keyed like the response cache (see coalesce)
+    _inflight: Dict[tuple, "asyncio.Future"] = {}
+    # response_cache generation at which each of them started
+    _inflight_generations: Dict[tuple, int] = {}
+    # One circuit breaker per service, created on first use
+    _breakers: Dict[str, CircuitBreaker] = {}
+    # Last /health/deep result as (checked_at, result) and the probe run in progress
+    _deep_health: Optional[Tuple[float, Dict[str, Any]]] = None
+    _deep_health_task: Optional["asyncio.Task"] = None
+    # Bulkheads of the route classes and of the services, created on first use
+    _class_bulkheads: Dict[str, Bulkhead] = {}
+    _service_bulkheads: Dict[str, Bulkhead] = {}
+
     @staticmethod
-    def forward_request(service_name: str, path: str, method: str, headers: Dict, body: Optional[Dict] = None, 
-                       params: Optional[Dict] = None, timeout: int = 30) -> JSONResponse:
+    def get_service_config(service_name: str) -> Dict[str, Any]:
         """
-        Forward a request to the appropriate service
+        Return the registry entry of a service merged with the default settings
         """
         if service_name not in SERVICE_REGISTRY:
             raise HTTPException(status_code=404, detail=f"Service {service_name} not found")
-        
-        base_url = SERVICE_REGISTRY[service_name]
-        url = f"{base_url}{path}"
+        return {**DEFAULT_SERVICE_CONFIG, **SERVICE_REGISTRY[service_name]}
 
-        logger.info(f"Forwarding {method} request to {url}")
-        logger.info(f"Query params: {params}")
-        logger.info(f"Request body: {body}")
+    @staticmethod
+    def get_client(service_name: str) -> httpx.AsyncClient:
+        """
+        Get (or create) the pooled async client of a service
+        """
+        client = GatewayService._clients.get(service_name)
+        if client is None or client.is_closed:
+            config = GatewayService.get_service_config(service_name)
+            # Note: verify=False disables SSL verification (useful for self-signed certs)
+            client = httpx.AsyncClient(
+                http2=config["http2"],
+                verify=False,
+                limits=httpx.Limits(
+                    max_connections=config["max_connections"],
+                    max_keepalive_connections=config["max_keepalive"],
+                    keepalive_expiry=config["keepalive_expiry"]
+                ),
+                timeout=httpx.Timeout(config["timeout"], connect=config["connect_timeout"])
+            )
+            GatewayService._clients[service_name] = client
+        return client
+
+    @staticmethod
+    def get_breaker(service_name: str) -> CircuitBreaker:
+        """
+        Get (or create) the circuit breaker of a service
+        """
+        breaker = GatewayService._breakers.get(service_name)
+        if breaker is None:
+            config = GatewayService.get_service_config(service_name)
+            breaker = CircuitBreaker(
+                service_name,
+                window=config["breaker_window"],
+                min_calls=config["breaker_min_calls"],
+                failure_rate=config["breaker_failure_rate"],
+                open_seconds=config["breaker_open_seconds"],
+                half_open_probes=config["breaker_half_open_probes"]
+            )
+            GatewayService._breakers[service_name] = breaker
+        return breaker
+
+    @staticmethod
+    def check_breaker(service_name: str) -> CircuitBreaker:
+        """
+        Fail fast with a 503 when the circuit of a service is open
+        """
+        breaker = GatewayService.get_breaker(service_name)
+        if not breaker.allow():
+            logger.warning(f"Circuit open for {service_name}, failing fast")
+            raise HTTPException(
+                status_code=503,
+                detail=f"Service {service_name} is temporarily unavailable",
+                headers={"Retry-After": str(breaker.retry_after())}
+            )
+        return breaker
+
+    @staticmethod
+    def snapshot_breakers() -> Dict[str, Dict[str, Any]]:
+        """
+        State of the circuit breaker of every registered service
+        """
+        return {name: GatewayService.get_breaker(name).snapshot() for name in SERVICE_REGISTRY}
+
+    @staticmethod
+    def get_bulkheads(service_name: str) -> Tuple[Bulkhead, Bulkhead]:
+        """
+        Get (or create) the route class bulkhead and the own bulkhead of a service
+        """
+        config = GatewayService.get_service_config(service_name)
+        route_class = config["route_class"]
+        limits = ROUTE_CLASS_LIMITS[route_class]
 
+        class_bulkhead = GatewayService._class_bulkheads.get(route_class)
+        if class_bulkhead is None:
+            class_bulkhead = Bulkhead(route_class, limits["max_concurrent"], limits["max_queue"], limits["queue_timeout"])
+            GatewayService._class_bulkheads[route_class] = class_bulkhead
+
+        service_bulkhead = GatewayService._service_bulkheads.get(service_name)
+        if service_bulkhead is None:
+            service_bulkhead = Bulkhead(service_name, config["max_concurrent"], config["max_queue"], limits["queue_timeout"])
+            GatewayService._service_bulkheads[service_name] = service_bulkhead
+
+        return class_bulkhead, service_bulkhead
+
+    @staticmethod
+    async def acquire_bulkheads(service_name: str) -> Tuple[Bulkhead, ...]:
+        """
+        Take a slot in the route class bulkhead and then in the service bulkhead
+        """
+        acquired = []
         try:
-            # Prepare headers - remove hop-by-hop headers that shouldn't be forwarded
-            filtered_headers = {k: v for k, v in headers.items()
-                              if k.lower() not in ['host', 'connection', 'upgrade', 'keep-alive']}
+            for bulkhead in GatewayService.get_bulkheads(service_name):
+                await bulkhead.acquire()
+                acquired.append(bulkhead)
+        except BaseException:
+            GatewayService.release_bulkheads(acquired)
+            raise
+        return tuple(acquired)
 
-            logger.info(f"Filtered headers being sent: {list(filtered_headers.keys())}")
+    @staticmethod
+    def release_bulkheads(bulkheads):
+        """
+        Give back the slots taken with acquire_bulkheads
+        """
+        for bulkhead in reversed(bulkheads):
+            bulkhead.release()
 
-            # Make the request to the target service
-            # Note: verify=False disables SSL verification (useful for self-signed certs)
-            if method.upper() == "GET":
-                response = requests.get(url, headers=filtered_headers, params=params, timeout=timeout, verify=False)
-            elif method.upper() == "POST":
-                response = requests.post(url, json=body, headers=filtered_headers, params=params, timeout=timeout, verify=False)
-            elif method.upper() == "PUT":
-                response = requests.put(url, json=body, headers=filtered_headers, params=params, timeout=timeout, verify=False)
-            elif method.upper() == "PATCH":
-                response = requests.patch(url, json=body, headers=filtered_headers, params=params, timeout=timeout, verify=False)
-            elif method.upper() == "DELETE":
-                response = requests.delete(url, headers=filtered_headers, params=params, timeout=timeout, verify=False)
+    @staticmethod
+    def snapshot_bulkheads() -> Dict[str, Dict[str, Any]]:
+        """
+        Usage of the route class and service bulkheads created so far
+        """
+        return {
+            "route_classes": {name: bulkhead.snapshot() for name, bulkhead in GatewayService._class_bulkheads.items()},
+            "services": {name: bulkhead.snapshot() for name, bulkhead in GatewayService._service_bulkheads.items()},
+        }
+
+    @staticmethod
+    async def probe_service(service_name: str, timeout: float) -> Dict[str, Any]:
+        """
+        Probe the health path of a service, bypassing bulkheads and circuit breakers
+        """
+        config = GatewayService.get_service_config(service_name)
+        client = GatewayService.get_client(service_name)
+        started = time.perf_counter()
+        try:
+            response = await client.get(f"{config['url']}{config['health_path']}", timeout=timeout)
+            result = {"status": "up" if response.status_code < 500 else "down", "http_status": response.status_code}
+        except httpx.HTTPError as e:
+            result = {"status": "down", "error": type(e).__name__}
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+
+    @staticmethod
+    async def deep_health() -> Dict[str, Any]:
+        """
+        Probe every registered service concurrently under DEEP_HEALTH_DEADLINE.
+        Results are reused for DEEP_HEALTH_CACHE_SECONDS and concurrent callers share one run,
+        so probes and dashboards can't trigger a probe storm.
+        """
+        cached = GatewayService._deep_health
+        if cached is not None and time.monotonic() - cached[0] < DEEP_HEALTH_CACHE_SECONDS:
+            return cached[1]
+        if GatewayService._deep_health_task is None:
+            GatewayService._deep_health_task = asyncio.ensure_future(GatewayService._run_deep_health())
+            GatewayService._deep_health_task.add_done_callback(
+                lambda _: setattr(GatewayService, "_deep_health_task", None))
+        return await asyncio.shield(GatewayService._deep_health_task)
+
+    @staticmethod
+    async def _run_deep_health() -> Dict[str, Any]:
+        started = time.perf_counter()
+        tasks = {name: asyncio.ensure_future(GatewayService.probe_service(name, DEEP_HEALTH_DEADLINE))
+                 for name in SERVICE_REGISTRY}
+        await asyncio.wait(tasks.values(), timeout=DEEP_HEALTH_DEADLINE)
+
+        services = {}
+        for name, task in tasks.items():
+            if task.done():
+                services[name] = task.result()
             else:
-                raise HTTPException(status_code=405, detail=f"Method {method} not allowed")
-            
-            # Create response with the same status code and content
-            content = response.content
-            response_headers = dict(response.headers)
+                task.cancel()
+                services[name] = {"status": "down", "error": "deadline exceeded",
+                                  "latency_ms": DEEP_HEALTH_DEADLINE * 1000}
+            services[name]["circuit_breaker"] = GatewayService.get_breaker(name).state
+
+        result = {
+            "status": "healthy" if all(service["status"] == "up" for service in services.values()) else "degraded",
+            "checked_in_ms": round((time.perf_counter() - started) * 1000, 1),
+            "services": services,
+        }
+        GatewayService._deep_health = (time.monotonic(), result)
+        return result
 
-            logger.info(f"Received response from {service_name}: status={response.status_code}")
+    @staticmethod
+    async def close_clients():
+        """
+        Close every pooled client (called on application shutdown)
+        """
+        clients = list(GatewayService._clients.values())
+        GatewayService._clients.clear()
+        for client in clients:
+            await client.aclose()
 
-            # Remove hop-by-hop headers and content-length from the response
-            headers_to_remove = ['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade', 'content-length']
-            filtered_response_headers = {k: v for k, v in response_headers.items()
-                                       if k.lower() not in headers_to_remove}
+    @staticmethod
+    async def forward_request(service_name: str, path: str, method: str, headers: Dict, body: Optional[Dict] = None,
+                              params: Optional[Dict] = None, timeout: Optional[float] = None,
+                              cache_route: Optional[str] = None,
+                              cache_tag: Optional[str] = None, cache_ttl: Optional[float] = None) -> Response:
+        """
+        Forward a request to the appropriate service
+
+        The upstream status, headers and body bytes are passed through as-is
+        (see UpstreamResponse for how the upstream's content-encoding is negotiated).
+        GET requests with a cache_route are served from response_cache while fresh; cache_tag
+        groups the entry so writes can invalidate it and cache_ttl overrides the route's TTL.
+        Identical GETs that arrive while one is in flight share its upstream call.
+        """
+        method = method.upper()
+        cache_key = None
+        if method == "GET":
+            cache_key = ResponseCache.make_key(cache_route or service_name, path, params, headers)
+            if cache_route:
+                cached = response_cache.get(cache_key)
+                if cached is not None:
+                    status_code, cached_headers, cached_body = cached
+                    return UpstreamResponse(status_code, {**cached_headers, "X-Cache": "HIT"}, cached_body)
+
+        if cache_key is not None:
+            # Generation the upstream call started at (the one in flight when joining it)
+            since = GatewayService._inflight_generations.get(cache_key, response_cache.generation)
+            status_code, response_headers, content = await GatewayService.coalesce(
+                cache_key, service_name, path, method, headers, body, params, timeout)
+            if cache_route and status_code == 200:
+                response_cache.set(cache_key, cache_tag or cache_route, status_code, response_headers, content,
+                                   cache_ttl, since)
+        else:
+            status_code, response_headers, content = await GatewayService.fetch(
+                service_name, path, method, headers, body, params, timeout)
+
+        # Forward the upstream bytes unchanged - no decoding or re-serialization
+        # (and no recompression when the client accepts the upstream's encoding)
+        return UpstreamResponse(status_code, response_headers, content)
+
+    @staticmethod
+    async def forward_command(command: str, service_name: str, path: str, headers: Dict, body: Dict,
+                              timeout: Optional[float] = None, stream: bool = False) -> Response:
+        """
+        POST a bot command through the persistent answer cache. An answer is reused by anyone sending
+        the same normalized message, and identical questions in flight share one upstream call.
+        With stream=True the answer is relayed as Server-Sent Events (see stream_events).
+        """
+        key = answer_cache.make_key(command, body.get("message"))
+        if key is None:
+            if stream:
+                return GatewayService.stream_events(service_name, path, headers, body, timeout)
+            return await GatewayService.forward_request(service_name, path, "POST", headers, body, timeout=timeout)
+
+        cached = await answer_cache.get(key)
+        if cached is not None:
+            status_code, response_headers, content = cached
+            if stream:
+                return GatewayService.answer_events(status_code, response_headers, content)
+            return UpstreamResponse(status_code, {**response_headers, "X-Cache": "HIT"}, content)
+
+        if stream:
+            def store_answer(status_code: int, response_headers: Dict, content: bytes):
+                if status_code == 200:
+                    answer_cache.set(key, command, status_code, response_headers, content)
+
+            return GatewayService.stream_events(service_name, path, headers, body, timeout, on_answer=store_answer)
+
+        status_code, response_headers, content = await GatewayService.coalesce(
+            ("answer", key), service_name, path, "POST", headers, body, None, timeout)
+        if status_code == 200:
+            answer_cache.set(key, command, status_code, response_headers, content)
+        return UpstreamResponse(status_code, response_headers, content)
 
-            # Parse content appropriately based on content type
-            content_type = response.headers.get('content-type', '').lower()
+    @staticmethod
+    def submit_command(command: str, service_name: str, path: str, headers: Dict, body: Dict,
+                       timeout: Optional[float] = None) -> JSONResponse:
+        """
+        Run a bot command as a background job (see CommandJobs) and answer 202 with the job id.
+        The answer is then fetched from /api/commands/jobs/{job_id}.
+        """
+        job = command_jobs.submit(command, headers, lambda: GatewayService.forward_command(
+            command, service_name, path, headers, body, timeout))
+        location = f"/api/commands/jobs/{job.job_id}"
+        return JSONResponse(
+            status_code=202,
+            content={**job.snapshot(), "location": location},
+            headers={"Location": location, "Retry-After": "1"}
+        )
 
-            if content:
-                # For content that might be JSON, check if it starts with JSON-like characters
+    @staticmethod
+    async def forward_search(route: str, path: str, request: Request) -> Response:
+        """
+        GET a search through search_cache. The query is normalized before it is looked up and sent.
+        A search sent with an X-Search-Client id is answered with a 409 as soon as a newer one from the
+        same user and client id on the same route supersedes it (useSearch ignores those), cancelling its
+        upstream call; searches from other tabs or components of the user don't. With
+        SEARCH_DEBOUNCE_SECONDS it also waits that long before it is sent.
+        """
+        headers = dict(request.headers)
+        params = {k: v for k, v in request.query_params.items() if v != ""}
+        if "q" in params:
+            params["q"] = SearchCache.normalize(params["q"])
+        identity = ResponseCache.user_identity(headers)
+        key = SearchCache.make_key(route, params, identity)
+        # Anonymous callers can't be told apart, and without a client id two search boxes of the same
+        # user could supersede each other, so neither is debounced
+        client = headers.get("x-search-client", "")
+        slot = None
+        if identity != "anonymous" and client and len(client) <= SEARCH_CLIENT_MAX_LENGTH:
+            slot = (route, identity, client)
+        superseded = search_debouncer.start(slot) if slot is not None else None
+        try:
+            cached = search_cache.get(key)
+            if cached is not None:
+                status_code, response_headers, content, cache_status = cached
+                return UpstreamResponse(status_code, {**response_headers, "X-Cache": cache_status}, content)
+
+            if superseded is None:
+                status_code, response_headers, content = await GatewayService.fetch(
+                    "search", path, "GET", headers, params=params)
+            else:
+                if SEARCH_DEBOUNCE_SECONDS > 0:
+                    try:
+                        await asyncio.wait_for(superseded.wait(), SEARCH_DEBOUNCE_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                if superseded.is_set():
+                    raise HTTPException(status_code=409, detail="Superseded by a newer search")
+                fetch = asyncio.ensure_future(GatewayService.fetch("search", path, "GET", headers, params=params))
+                dropped = asyncio.ensure_future(superseded.wait())
                 try:
-                    content_str = content.decode('utf-8')
-                    if 'application/json' in content_type and (content_str.strip().startswith('{') or content_str.strip().startswith('[')):
-                        # Handle JSON content
+                    await asyncio.wait((fetch, dropped), return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    dropped.cancel()
+                    dropped_first = not fetch.done()
+                    if dropped_first:
+                        fetch.cancel()
+                if dropped_first:
+                    raise HTTPException(status_code=409, detail="Superseded by a newer search")
+                status_code, response_headers, content = fetch.result()
+
+            search_cache.set(key, status_code, response_headers, content)
+            return UpstreamResponse(status_code, response_headers, content)
+        finally:
+            if slot is not None:
+                search_debouncer.finish(slot, superseded)
+
+    @staticmethod
+    async def search_messages(request: Request) -> Response:
+        """
+        Search messages in message_index first. A search from an authenticated caller whose page is
+        filled by the recent messages of the threads it has read is answered locally; otherwise the
+        search service is asked (see forward_search) and, on the first page, the caller's recent
+        matches are put ahead of its results.
+        """
+        headers = dict(request.headers)
+        params = {k: v for k, v in request.query_params.items() if v != ""}
+        limit = int(params["limit"]) if params.get("limit", "").isdigit() else 20
+        offset = int(params["offset"]) if params.get("offset", "").isdigit() else 0
+        recent, key = None, None
+        if await GatewayService.resolve_user(headers) is not None:
+            identity = ResponseCache.user_identity(headers)
+            key = MessageIndex.total_key(params, identity)
+            known = message_index.known_total(key)
+            with tracer.span("message_index"):
+                found = message_index.search(params, offset + limit, identity, known[1] if known else None)
+            if found is not None:
+                recent, total, newer = found
+                payload = None
+                if len(recent) >= offset + limit:
+                    # The search service's total plus the matches created since it answered
+                    corpus_total = max(total, known[0] + newer) if known else None
+                    payload = message_index.render(recent[offset:offset + limit], corpus_total, limit, offset)
+                if payload is not None:
+                    message_index.local_answers += 1
+                    return JSONResponse(content=payload, headers={"X-Search-Source": "local"})
+
+        response = await GatewayService.forward_search("search_messages", "/api/message/search_message", request)
+        if response.status_code != 200 or not (key or message_index.payload_shape is None):
+            return response
+        try:
+            payload = json.loads(response.body)
+        except ValueError:
+            return response
+        message_index.learn_shape(payload)
+        results = payload.get("results") if isinstance(payload, dict) else payload
+        total = payload.get("total", payload.get("count")) if isinstance(payload, dict) else None
+        local = [message_index.to_result(message) for message in recent or ()]
+        if not recent or offset or not isinstance(results, list) or None in local:
+            if key is not None and isinstance(total, int):
+                message_index.remember_total(key, total)
+            return response
+        recent_ids = {str(message["id"]) for message in recent}
+        upstream = [result for result in results
+                    if not (isinstance(result, dict)
+                            and str(result.get("message_id", result.get("id"))) in recent_ids)]
+        # Local hits the search service didn't return
+        added = len(recent) - (len(results) - len(upstream))
+        merged = (local + upstream)[:limit]
+        if isinstance(payload, dict):
+            payload = {**payload, "results": merged}
+            for field in ("total", "count"):
+                if isinstance(payload.get(field), int):
+                    payload[field] += added
+            if isinstance(total, int):
+                message_index.remember_total(key, total + added)
+        else:
+            payload = merged
+        message_index.merged_answers += 1
+        return JSONResponse(content=payload, headers={"X-Search-Source": "merged"})
+
+    @staticmethod
+    def jwt_expiry(authorization: str) -> Optional[float]:
+        """
+        Epoch seconds at which a bearer JWT expires (None if the token isn't a JWT with an exp claim).
+        The signature is not checked, the users service stays the one validating tokens.
+        """
+        token = authorization[7:] if authorization.lower().startswith("bearer ") else authorization
+        parts = token.split(".")
+        if len(parts) != 3:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+            exp = payload.get("exp")
+        except (ValueError, AttributeError):
+            return None
+        return float(exp) if isinstance(exp, (int, float)) else None
+
+    @staticmethod
+    async def get_user_me(headers: Dict) -> Response:
+        """
+        GET /v1/users/me through the response cache, so a valid token costs one users-service
+        round trip per TTL instead of one per page load
+        """
+        ttl = CACHE_TTLS["user_me"]
+        expiry = GatewayService.jwt_expiry(headers.get("authorization", ""))
+        if expiry is not None:
+            ttl = min(ttl, expiry - time.time())
+        return await GatewayService.forward_request(
+            "users", "/v1/users/me", "GET", headers,
+            cache_route="user_me", cache_tag=f"user:{ResponseCache.user_identity(headers)}", cache_ttl=ttl)
+
+    @staticmethod
+    async def resolve_user(headers: Dict) -> Optional[Dict[str, Any]]:
+        """
+        User owning the request's bearer token, None when the token is missing or rejected.
+        Served from the same cache as /api/users/me, so routes can call it on every request.
+        """
+        if not headers.get("authorization"):
+            return None
+        try:
+            response = await GatewayService.get_user_me(headers)
+        except HTTPException:
+            return None
+        if response.status_code != 200:
+            return None
+        try:
+            user = json.loads(response.body)
+        except ValueError:
+            return None
+        return user if isinstance(user, dict) else None
+
+    @staticmethod
+    async def coalesce(key: tuple, service_name: str, path: str, method: str, headers: Dict,
+                       body: Optional[Dict] = None, params: Optional[Dict] = None,
+                       timeout: Optional[float] = None) -> Tuple[int, Dict, bytes]:
+        """
+        Singleflight: run fetch once per key, callers arriving while it is in flight await the same result
+        """
+        task = GatewayService._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                GatewayService.fetch(service_name, path, method, headers, body, params, timeout))
+            GatewayService._inflight[key] = task
+            GatewayService._inflight_generations[key] = response_cache.generation
+
+            def done(_):
+                GatewayService._inflight.pop(key, None)
+                GatewayService._inflight_generations.pop(key, None)
+
+            task.add_done_callback(done)
+        else:
+            logger.debug("Coalescing %s %s with the request already in flight", method, path)
+        # shield: a caller that disconnects must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+    @staticmethod
+    async def fetch(service_name: str, path: str, method: str, headers: Dict, body: Optional[Dict] = None,
+                    params: Optional[Dict] = None, timeout: Optional[float] = None) -> Tuple[int, Dict, bytes]:
+        """
+        Send a request to a service and return its status code, filtered headers and body bytes.
+        The body is kept in the upstream's content-encoding, given by the returned content-encoding header.
+        """
+        config = GatewayService.get_service_config(service_name)
+        if timeout is None:
+            timeout = config["timeout"]
+
+        base_url = config["url"]
+        url = f"{base_url}{path}"
+        # Drop unset params like requests did (httpx would send them as empty values)
+        if params:
+            params = {k: v for k, v in params.items() if v is not None}
+
+        logger.debug("Forwarding %s request to %s", method, url)
+
+        try:
+            # Prepare headers - remove hop-by-hop headers that shouldn't be forwarded
+            # (content-length is recomputed by the client since the body is re-encoded, and
+            # accept-encoding is replaced so services only use encodings the gateway can decode)
+            with tracer.span("filter_headers"):
+                filtered_headers = {k: v for k, v in headers.items()
+                                  if k.lower() not in ['host', 'connection', 'upgrade', 'keep-alive',
+                                                       'content-length', 'transfer-encoding', 'accept-encoding',
+                                                       'traceparent']}
+                filtered_headers["accept-encoding"] = UPSTREAM_ACCEPT_ENCODING
+
+            method = method.upper()
+            if method not in ["GET", "POST", "PUT", "PATCH", "DELETE"]:
+                raise HTTPException(status_code=405, detail=f"Method {method} not allowed")
+
+            bulkheads = await GatewayService.acquire_bulkheads(service_name)
+            try:
+                breaker = GatewayService.check_breaker(service_name)
+
+                # Make the request to the target service through its pooled client
+                client = GatewayService.get_client(service_name)
+                upstream_metrics = gateway_metrics.upstream(service_name)
+                timer = UpstreamTimer()
+                upstream_metrics.in_flight += 1
+                try:
+                    with tracer.span(f"upstream {service_name}", service=service_name,
+                                     **{"http.method": method, "http.url": url}) as span:
+                        traceparent = span.traceparent()
+                        if traceparent:
+                            filtered_headers["traceparent"] = traceparent
+                        upstream_request = client.build_request(
+                            method,
+                            url,
+                            json=body if method in ["POST", "PUT", "PATCH"] else None,
+                            headers=filtered_headers,
+                            params=params,
+                            timeout=httpx.Timeout(timeout, connect=config["connect_timeout"]),
+                            extensions={"trace": timer.trace}
+                        )
+                        # Read the raw body so a compressed response stays compressed
+                        response = await client.send(upstream_request, stream=True)
                         try:
-                            content_data = json.loads(content_str)
-                        except json.JSONDecodeError:
-                            # Not valid JSON despite the content type
-                            content_data = content_str
-                    else:
-                        # Handle non-JSON content
-                        content_data = content_str
-                except UnicodeDecodeError:
-                    # If UTF-8 decode fails, return as hex string or handle as binary
-                    content_data = content.hex()  # Convert binary data to hex string as fallback
-            else:
-                content_data = None
+                            content = b"".join([chunk async for chunk in response.aiter_raw()])
+                        finally:
+                            await response.aclose()
+                        span.attributes["http.status_code"] = response.status_code
+                except httpx.HTTPError:
+                    breaker.record(False)
+                    gateway_metrics.observe_upstream(upstream_metrics, timer, "error")
+                    raise
+                except BaseException:
+                    breaker.release()
+                    raise
+                finally:
+                    upstream_metrics.in_flight -= 1
+                breaker.record(response.status_code not in BREAKER_FAILURE_STATUSES)
+                gateway_metrics.observe_upstream(upstream_metrics, timer, response.status_code, len(content))
+            finally:
+                GatewayService.release_bulkheads(bulkheads)
+
+            # Remove hop-by-hop headers and content-length from the response
+            # (content-encoding is kept, it describes the raw body returned)
+            headers_to_remove = ['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade', 'content-length']
+            filtered_response_headers = {k: v for k, v in response.headers.items()
+                                       if k.lower() not in headers_to_remove}
 
-            logger.info(f"Forwarding response with status {response.status_code}")
+            return response.status_code, filtered_response_headers, content
 
-            # Return response with filtered headers (CORS is handled by middleware)
-            return JSONResponse(
-                status_code=response.status_code,
-                content=content_data,
-                headers=filtered_response_headers
-            )
-            
-        except requests.exceptions.Timeout:
-            logger.error(f"Timeout forwarding request to {service_name}")
-            raise HTTPException(status_code=408, detail=f"Request to {service_name} timed out after {timeout} seconds")
-        except requests.exceptions.ConnectionError as e:
-            logger.error(f"Connection error to {service_name}: {str(e)}")
-            raise HTTPException(status_code=502, detail=f"Connection error to {service_name}")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Request error forwarding to {service_name}: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error calling {service_name}: {str(e)}")
+        except HTTPException:
+            raise
+        except httpx.HTTPError as e:
+            raise GatewayService.upstream_error(service_name, e, timeout)
         except Exception as e:
             logger.error(f"Unexpected error forwarding request to {service_name}: {str(e)}", exc_info=True)
             raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
+    @staticmethod
+    async def open_stream(service_name: str, method: str, path: str, headers: Dict, params: Optional[Dict] = None,
+                          content: Any = None, json_body: Any = None, timeout: Optional[float] = None):
+        """
+        Send a request to a service and return (response, close) as soon as the response headers
+        arrive, with the body still unread. close(relayed_bytes) must be awaited once the body has
+        been relayed: until then the call holds its bulkhead slots and counts as in flight.
+        """
+        config = GatewayService.get_service_config(service_name)
+        if timeout is None:
+            timeout = config["timeout"]
+        url = f"{config['url']}{path}"
+
+        # Ended in close(), once the body has been relayed
+        span = tracer.start_span(f"upstream {service_name}", service=service_name,
+                                 **{"http.method": method, "http.url": url, "streamed": True})
+        traceparent = span.traceparent()
+        if traceparent:
+            headers = {**headers, "traceparent": traceparent}
+
+        # The bulkhead slots are held until the response body has been fully relayed
+        bulkheads = await GatewayService.acquire_bulkheads(service_name)
+        try:
+            breaker = GatewayService.check_breaker(service_name)
+            client = GatewayService.get_client(service_name)
+            timer = UpstreamTimer()
+            upstream_request = client.build_request(
+                method,
+                url,
+                content=content,
+                json=json_body,
+                headers=headers,
+                params=params,
+                timeout=httpx.Timeout(timeout, connect=config["connect_timeout"]),
+                extensions={"trace": timer.trace}
+            )
+
+            upstream_metrics = gateway_metrics.upstream(service_name)
+            try:
+                response = await client.send(upstream_request, stream=True)
+            except httpx.HTTPError as e:
+                breaker.record(False)
+                gateway_metrics.observe_upstream(upstream_metrics, timer, "error")
+                raise GatewayService.upstream_error(service_name, e, timeout)
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record(response.status_code not in BREAKER_FAILURE_STATUSES)
+        except BaseException as e:
+            GatewayService.release_bulkheads(bulkheads)
+            tracer.end_span(span, e)
+            raise
+        span.attributes["http.status_code"] = response.status_code
+
+        # Counted in flight (and timed) until the body has been relayed
+        upstream_metrics.in_flight += 1
+        closed = False
+
+        async def close(relayed: int = 0):
+            # Idempotent: callers run it both from their relay loop and as a background task
+            nonlocal closed
+            if not closed:
+                closed = True
+                GatewayService.release_bulkheads(bulkheads)
+                upstream_metrics.in_flight -= 1
+                gateway_metrics.observe_upstream(upstream_metrics, timer, response.status_code, relayed)
+                tracer.end_span(span)
+                await response.aclose()
+
+        return response, close
+
+    @staticmethod
+    async def stream_request(service_name: str, path: str, request: Request, params: Optional[Dict] = None,
+                             timeout: Optional[float] = None) -> StreamingResponse:
+        """
+        Stream the request body to a service and relay its response back chunk by chunk.
+        Neither body is buffered in the gateway, so memory use stays flat for any payload size.
+        """
+        method = request.method.upper()
+        logger.debug("Streaming %s request to %s%s", method, service_name, path)
+
+        # Keep content-length and content-type (multipart boundary) so the body reaches the service as sent
+        filtered_headers = {k: v for k, v in request.headers.items()
+                            if k.lower() not in ['host', 'connection', 'upgrade', 'keep-alive', 'transfer-encoding',
+                                                 'traceparent']}
+        response, close = await GatewayService.open_stream(
+            service_name, method, path, filtered_headers, params=params,
+            content=request.stream() if method in ["POST", "PUT", "PATCH"] else None, timeout=timeout)
+
+        async def relay():
+            relayed = 0
+            try:
+                async for chunk in response.aiter_raw():
+                    relayed += len(chunk)
+                    yield chunk
+            finally:
+                await close(relayed)
+
+        # Raw (still encoded) chunks are relayed, so content-length and content-encoding stay valid
+        headers_to_remove = ['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade']
+        filtered_response_headers = {k: v for k, v in response.headers.items()
+                                     if k.lower() not in headers_to_remove}
+
+        # StreamingResponse only pulls the next chunk once the previous one was sent (backpressure)
+        return StreamingResponse(
+            relay(),
+            status_code=response.status_code,
+            headers=filtered_response_headers,
+            background=BackgroundTask(close)
+        )
+
+    @staticmethod
+    def stream_events(service_name: str, path: str, headers: Dict, body: Dict, timeout: Optional[float] = None,
+                      on_answer=None) -> StreamingResponse:
+        """
+        POST body to a service and relay its answer as Server-Sent Events while it is produced.
+        The event stream starts right away, so the status code is reported in the events:
+          - upstream SSE events are relayed as they are
+          - any other body is relayed in "chunk" events holding the text as it arrives
+          - a final "done" event carries the upstream status code, or an "error" event the
+            status and detail of a failed call
+        ": heartbeat" comments go out every REALTIME_HEARTBEAT_SECONDS without data, also while
+        waiting for the first byte, so idle proxies don't close the connection.
+        on_answer(status_code, headers, body) receives non-SSE answers up to STREAM_ANSWER_MAX_BYTES.
+        """
+        if timeout is None:
+            timeout = GatewayService.get_service_config(service_name)["timeout"]
+        filtered_headers = {k: v for k, v in headers.items()
+                            if k.lower() not in ['host', 'connection', 'upgrade', 'keep-alive', 'content-length',
+                                                 'content-type', 'transfer-encoding', 'accept', 'accept-encoding',
+                                                 'traceparent']}
+        # Invite the service to stream, uncompressed so chunks can be relayed as they come
+        filtered_headers["accept"] = "text/event-stream, application/json;q=0.9, */*;q=0.8"
+        filtered_headers["accept-encoding"] = "identity"
+
+        # Bounded: the upstream isn't read faster than the client takes the events
+        events: asyncio.Queue = asyncio.Queue(maxsize=16)
+
+        async def read_answer() -> bytes:
+            """Relay the upstream answer to events, returning the event that ends the stream"""
+            try:
+                response, close = await GatewayService.open_stream(
+                    service_name, "POST", path, filtered_headers, json_body=body, timeout=timeout)
+            except HTTPException as e:
+                return sse_event("error", json.dumps({"status": e.status_code, "detail": e.detail}))
+
+            # Text of a non-SSE answer, kept for on_answer while it is short enough
+            answer: Optional[list] = []
+            answer_size = 0
+            try:
+                if response.headers.get("content-type", "").startswith("text/event-stream"):
+                    answer = None
+                    async for chunk in response.aiter_raw():
+                        await events.put(chunk)
+                else:
+                    async for text in response.aiter_text():
+                        if answer is not None:
+                            answer.append(text)
+                            answer_size += len(text)
+                            if answer_size > STREAM_ANSWER_MAX_BYTES:
+                                answer = None
+                        await events.put(sse_event("chunk", text))
+            except httpx.HTTPError as e:
+                error = GatewayService.upstream_error(service_name, e, timeout)
+                return sse_event("error", json.dumps({"status": error.status_code, "detail": error.detail}))
+            finally:
+                await close(response.num_bytes_downloaded)
+            if on_answer is not None and answer is not None:
+                on_answer(response.status_code,
+                          {"content-type": response.headers.get("content-type", "application/json")},
+                          "".join(answer).encode())
+            return sse_event("done", json.dumps({"status": response.status_code}))
+
+        async def pump():
+            # Whatever ends the answer, the client gets a final event and relay() its end marker
+            # (unless relay() is gone: it cancels this task when the client disconnects)
+            final = sse_event("error", json.dumps({"status": 500, "detail": "Unexpected error while streaming the answer"}))
+            cancelled = False
+            try:
+                final = await read_answer()
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            except Exception:
+                logger.exception(f"Streaming the answer of {service_name} failed")
+            finally:
+                if not cancelled:
+                    await events.put(final)
+                    await events.put(None)
+
+        async def relay():
+            task = asyncio.ensure_future(pump())
+            at_boundary = True
+            try:
+                while True:
+                    try:
+                        event = await asyncio.wait_for(events.get(), REALTIME_HEARTBEAT_SECONDS)
+                    except asyncio.TimeoutError:
+                        # Only between events: raw upstream chunks can end in the middle of one
+                        if at_boundary:
+                            yield b": heartbeat\n\n"
+                        continue
+                    if event is None:
+                        break
+                    yield event
+                    at_boundary = event.endswith((b"\n\n", b"\r\n\r\n"))
+            finally:
+                # The client went away (or the answer is complete): stop reading the upstream
+                task.cancel()
+
+        return StreamingResponse(relay(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @staticmethod
+    def answer_events(status_code: int, headers: Dict, content: bytes) -> StreamingResponse:
+        """A stored answer in the event format of stream_events"""
+        text = decode_content(headers.get("content-encoding"), content).decode("utf-8", errors="replace")
+        events = [sse_event("chunk", text), sse_event("done", json.dumps({"status": status_code}))]
+
+        async def relay():
+            for event in events:
+                yield event
+
+        return StreamingResponse(relay(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache": "HIT"})
+
+    @staticmethod
+    def upstream_error(service_name: str, error: httpx.HTTPError, timeout: float) -> HTTPException:
+        """
+        Map an httpx error to the HTTPException returned to the caller
+        """
+        if isinstance(error, httpx.TimeoutException):
+            logger.error(f"Timeout forwarding request to {service_name}")
+            return HTTPException(status_code=408, detail=f"Request to {service_name} timed out after {timeout} seconds")
+        if isinstance(error, (httpx.NetworkError, httpx.RemoteProtocolError)):
+            logger.error(f"Connection error to {service_name}: {str(error)}")
+            return HTTPException(status_code=502, detail=f"Connection error to {service_name}")
+        logger.error(f"Request error forwarding to {service_name}: {str(error)}")
+        return HTTPException(status_code=500, detail=f"Error calling {service_name}: {str(error)}")
 
 # Health check endpoint
 @app.get("/health")
 async def gateway_health():
     """Health check for the gateway"""
-    return {"status": "healthy", "services": list(SERVICE_REGISTRY.keys())}
+    return {
+        "status": "healthy",
+        "services": list(SERVICE_REGISTRY.keys()),
+        "circuit_breakers": {name: state["state"] for name, state in GatewayService.snapshot_breakers().items()}
+    }
+
+
+@app.get("/health/deep")
+async def gateway_deep_health():
+    """
+    Status and latency of every registered service, probed concurrently.
+    Always answers 200 so an upstream outage doesn't get the gateway pod restarted.
+    """
+    return await GatewayService.deep_health()
 
 
 # Specific endpoints for each service with more descriptive routes
@@ -172,7 +2987,7 @@ async def gateway_health():
 async def users_health(request: Request):
     if request.method == "OPTIONS":
         return JSONResponse(status_code=200, content={})
-    return GatewayService.forward_request("users", "/health", "GET", {})
+    return await GatewayService.forward_request("users", "/health", "GET", {})
 
 @app.post("/api/users/register")
 @app.options("/api/users/register")
@@ -181,7 +2996,7 @@ async def user_register(request: Request):
         return JSONResponse(status_code=200, content={})
     headers = dict(request.headers)
     body = await request.json() if request.method == "POST" else None
-    return GatewayService.forward_request("users", "/v1/users/register", "POST", headers, body)
+    return await GatewayService.forward_request("users", "/v1/users/register", "POST", headers, body)
 
 @app.post("/api/users/login")
 @app.options("/api/users/login")
@@ -190,7 +3005,7 @@ async def user_login(request: Request):
         return JSONResponse(status_code=200, content={})
     headers = dict(request.headers)
     body = await request.json() if request.method == "POST" else None
-    return GatewayService.forward_request("users", "/v1/auth/login", "POST", headers, body)
+    return await GatewayService.forward_request("users", "/v1/auth/login", "POST", headers, body)
 
 @app.get("/api/users/me")
 @app.options("/api/users/me")
@@ -198,8 +3013,7 @@ async def user_me(request: Request):
     if request.method == "OPTIONS":
         return JSONResponse(status_code=200, content={})
     headers = dict(request.headers)
-    logger.info(f"Authorization header: {headers.get('authorization', 'NOT FOUND')}")
-    return GatewayService.forward_request("users", "/v1/users/me", "GET", headers)
+    return await GatewayService.get_user_me(headers)
 
 @app.patch("/api/users/me")
 @app.options("/api/users/me")
@@ -208,41 +3022,51 @@ async def update_user_me(request: Request):
         return JSONResponse(status_code=200, content={})
     headers = dict(request.headers)
     body = await request.json() if request.method == "PATCH" else None
-    return GatewayService.forward_request("users", "/v1/users/me", "PATCH", headers, body)
+    response = await GatewayService.forward_request("users", "/v1/users/me", "PATCH", headers, body)
+    response_cache.invalidate(f"user:{ResponseCache.user_identity(headers)}")
+    return response
 
 
 # Channels service endpoints
 @app.get("/api/channels/health")
 async def channels_health():
-    return GatewayService.forward_request("channels", "/health", "GET", {})
+    return await GatewayService.forward_request("channels", "/health", "GET", {})
 
 @app.get("/api/channels")
 async def list_channels(request: Request):
     headers = dict(request.headers)
     params = dict(request.query_params)
-    return GatewayService.forward_request("channels", "/v1/channels/", "GET", headers, params=params)
+    return await GatewayService.forward_request("channels", "/v1/channels/", "GET", headers, params=params,
+                                                cache_route="list_channels", cache_tag="channels")
 
 @app.post("/api/channels")
 async def create_channel(request: Request):
     headers = dict(request.headers)
     body = await request.json() if request.method == "POST" else None
-    return GatewayService.forward_request("channels", "/v1/channels/", "POST", headers, body)
+    response = await GatewayService.forward_request("channels", "/v1/channels/", "POST", headers, body)
+    response_cache.invalidate("channels")
+    return response
 
 @app.get("/api/channels/{channel_id}")
 async def get_channel(channel_id: str, request: Request):
     headers = dict(request.headers)
-    return GatewayService.forward_request("channels", f"/v1/channels/{channel_id}", "GET", headers)
+    return await GatewayService.forward_request("channels", f"/v1/channels/{channel_id}", "GET", headers,
+                                                cache_route="get_channel", cache_tag=f"channel:{channel_id}")
 
 @app.put("/api/channels/{channel_id}")
 async def update_channel(channel_id: str, request: Request):
     headers = dict(request.headers)
     body = await request.json() if request.method == "PUT" else None
-    return GatewayService.forward_request("channels", f"/v1/channels/{channel_id}", "PUT", headers, body)
+    response = await GatewayService.forward_request("channels", f"/v1/channels/{channel_id}", "PUT", headers, body)
+    response_cache.invalidate("channels", f"channel:{channel_id}")
+    return response
 
 @app.delete("/api/channels/{channel_id}")
 async def delete_channel(channel_id: str, request: Request):
     headers = dict(request.headers)
-    return GatewayService.forward_request("channels", f"/v1/channels/{channel_id}", "DELETE", headers)
+    response = await GatewayService.forward_request("channels", f"/v1/channels/{channel_id}", "DELETE", headers)
+    response_cache.invalidate("channels", f"channel:{channel_id}", f"threads:{channel_id}")
+    return response
 
 
 # Threads service endpoints - Special handling for POST /api/threads
@@ -254,7 +3078,7 @@ async def create_thread(
     thread_name: str = None
 ):
     """Create a new thread - matches test logic"""
-    logger.info(f"POST /api/threads called with channel_id={channel_id}, user_id={user_id}, thread_name={thread_name}")
+    logger.debug("POST /api/threads called with channel_id=%s, user_id=%s", channel_id, user_id)
     headers = dict(request.headers)
     params = {
         "channel_id": channel_id,
@@ -262,7 +3086,9 @@ async def create_thread(
         "thread_name": thread_name
     }
     # Forward to /threads/ (final URL will be https://threads.inf326.nursoft.dev/threads/threads/)
-    return GatewayService.forward_request("threads", "/threads/", "POST", headers, None, params)
+    response = await GatewayService.forward_request("threads", "/threads/", "POST", headers, None, params)
+    response_cache.invalidate(f"threads:{channel_id}")
+    return response
 
 @app.options("/api/threads")
 async def create_thread_options(request: Request):
@@ -292,15 +3118,20 @@ async def proxy_threads(request: Request, path: str):
         body = await request.json()
 
     # Add /threads/ prefix for threads service
-    logger.info(f"{request.method} /api/threads/{path} -> /threads/{path}")
-    return GatewayService.forward_request("threads", f"/threads/{path}", request.method, headers, body, params)
+    logger.debug("%s /api/threads/%s -> /threads/%s", request.method, path, path)
+    response = await GatewayService.forward_request("threads", f"/threads/{path}", request.method, headers, body, params)
+    if request.method != "GET":
+        # The thread's channel is not part of the path, so drop every cached thread list
+        response_cache.invalidate("threads:", prefix=True)
+    return response
 
 @app.get("/api/channels/{channel_id}/threads")
 async def get_channel_threads(channel_id: str, request: Request):
     headers = dict(request.headers)
     params = dict(request.query_params)
     params['channel_id'] = channel_id
-    return GatewayService.forward_request("threads", "/channel/get_threads", "GET", headers, params=params)
+    return await GatewayService.forward_request("threads", "/channel/get_threads", "GET", headers, params=params,
+                                                cache_route="get_channel_threads", cache_tag=f"threads:{channel_id}")
 
 
 # Messages service endpoints - Catch-all proxy without validation
@@ -326,48 +3157,236 @@ async def proxy_messages(request: Request, path: str):
     if request.method in ["POST", "PUT", "PATCH"]:
         body = await request.json()
 
-    logger.info(f"{request.method} /api/messages/{path} -> /{path}")
-    return GatewayService.forward_request("messages", f"/{path}", request.method, headers, body, params)
+    logger.debug("%s /api/messages/%s -> /%s", request.method, path, path)
+    response = await GatewayService.forward_request("messages", f"/{path}", request.method, headers, body, params)
+    if response.status_code < 300:
+        if request.method != "GET":
+            message_hub.publish_write(path, request.method, response.body)
+        index_messages(path, request.method, headers, response)
+    return response
+
+
+def index_messages(path: str, method: str, headers: Dict, response: UpstreamResponse):
+    """Keep message_index up to date with a successful messages request (path is relative to the service)"""
+    match = MESSAGE_PATH_PATTERN.match(path)
+    if match is None:
+        return
+    thread_id, message_id = match.groups()
+    if method != "DELETE" and headers.get("authorization"):
+        # The messages service accepted this caller on the thread
+        message_index.grant(thread_id, ResponseCache.user_identity(headers))
+    if method == "GET" and message_id is None:
+        message_index.add_page(thread_id, response)
+    elif method == "DELETE" and message_id is not None:
+        message_index.remove(message_id)
+    elif method in ["POST", "PUT", "PATCH"]:
+        try:
+            message = json.loads(response.body) if response.body else None
+        except ValueError:
+            message = None
+        if isinstance(message, dict) and message.get("id") is not None:
+            message_index.add(thread_id, message)
+        elif message_id is not None:
+            # An edit whose new content we can't see: don't keep answering with the old one
+            message_index.remove(message_id)
+
+
+# Real-time message push - WebSocket with an SSE fallback, both fed by message_hub
+async def realtime_user(token: Optional[str], headers: Dict) -> Optional[Dict[str, Any]]:
+    """
+    Resolve the user of a real-time connection. Browsers can't set headers on WebSocket
+    or EventSource connections, so the bearer token may also come in the token query param.
+    """
+    if token:
+        headers = {"authorization": f"Bearer {token}"}
+    return await GatewayService.resolve_user(headers)
+
+async def can_read_thread(token: Optional[str], headers: Dict, user: Dict[str, Any], thread_id: str) -> bool:
+    """
+    Whether the messages service lets the user read a thread, checked by reading one message of it
+    with the user's credentials (successful checks are cached for the thread_access TTL)
+    """
+    authorization = f"Bearer {token}" if token else headers.get("authorization", "")
+    check_headers = {"authorization": authorization, "x-user-id": str(user.get("id", ""))}
+    try:
+        response = await GatewayService.forward_request(
+            "messages", f"/threads/{quote(thread_id, safe='')}/messages", "GET", check_headers,
+            params={"limit": 1}, cache_route="thread_access", cache_tag=f"thread_access:{thread_id}")
+    except HTTPException:
+        return False
+    return response.status_code == 200
+
+@app.websocket("/api/realtime/ws")
+async def realtime_websocket(websocket: WebSocket):
+    """
+    Push message events of the subscribed threads.
+    Threads are given as thread_id query params and can be changed by sending
+    {"action": "subscribe" | "unsubscribe", "thread_id": "..."}. Threads the user can't
+    read get a {"type": "subscription.denied", "thread_id": "..."} event instead.
+    """
+    user = await realtime_user(websocket.query_params.get("token"), dict(websocket.headers))
+    if user is None:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    token, headers = websocket.query_params.get("token"), dict(websocket.headers)
+
+    subscriber = message_hub.connect()
+
+    async def subscribe(thread_id: str):
+        if await can_read_thread(token, headers, user, thread_id):
+            message_hub.subscribe(subscriber, thread_id)
+        else:
+            # Through the queue, send_events is the only task writing to the socket
+            await subscriber.put(json.dumps({"type": "subscription.denied", "thread_id": thread_id}))
+
+    for thread_id in websocket.query_params.getlist("thread_id"):
+        await subscribe(thread_id)
+
+    async def receive_commands():
+        while True:
+            command = await websocket.receive_json()
+            thread_id = str(command.get("thread_id", ""))
+            if command.get("action") == "subscribe" and thread_id:
+                await subscribe(thread_id)
+            elif command.get("action") == "unsubscribe" and thread_id:
+                message_hub.unsubscribe(subscriber, thread_id)
+
+    async def send_events():
+        while True:
+            await websocket.send_text(await subscriber.get())
+
+    tasks = [asyncio.ensure_future(receive_commands()), asyncio.ensure_future(send_events())]
+    try:
+        # Either side ending (disconnect, bad command, send error) closes the connection
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        message_hub.disconnect(subscriber)
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.close()
+
+@app.get("/api/realtime/sse")
+async def realtime_sse(request: Request):
+    """
+    Server-Sent Events fallback of /api/realtime/ws for the threads given as thread_id params
+    (403 if the user can't read one of them)
+    """
+    user = await realtime_user(request.query_params.get("token"), dict(request.headers))
+    if user is None:
+        raise HTTPException(status_code=401, detail="A valid bearer token is required")
+
+    thread_ids = request.query_params.getlist("thread_id")
+    allowed = await asyncio.gather(*(can_read_thread(request.query_params.get("token"), dict(request.headers),
+                                                     user, thread_id) for thread_id in thread_ids))
+    denied = [thread_id for thread_id, ok in zip(thread_ids, allowed) if not ok]
+    if denied:
+        raise HTTPException(status_code=403, detail=f"Not allowed to read threads: {', '.join(denied)}")
+
+    subscriber = message_hub.connect()
+    for thread_id in thread_ids:
+        message_hub.subscribe(subscriber, thread_id)
+
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    payload = await asyncio.wait_for(subscriber.get(), REALTIME_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield f"event: message\ndata: {payload}\n\n"
+        finally:
+            message_hub.disconnect(subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 # Presence service endpoints
 @app.get("/api/presence/health")
 async def presence_health():
-    return GatewayService.forward_request("presence", "/api/v1.0.0/presence/health", "GET", {})
+    return await GatewayService.forward_request("presence", "/api/v1.0.0/presence/health", "GET", {})
 
 @app.post("/api/presence")
 async def register_presence(request: Request):
     headers = dict(request.headers)
     body = await request.json() if request.method == "POST" else None
-    return GatewayService.forward_request("presence", "/api/v1.0.0/presence", "POST", headers, body)
+    response = await GatewayService.forward_request("presence", "/api/v1.0.0/presence", "POST", headers, body)
+    user_id = (body or {}).get("userId") or (body or {}).get("user_id")
+    if response.status_code < 300 and user_id:
+        presence_table.record(str(user_id), body)
+    return response
+
+# Listing, stats and lookups are served from presence_table (seeded once from the presence service).
+# The presence service only answers authenticated callers, so the table doesn't either.
+async def require_presence_caller(headers: Dict) -> Dict[str, Any]:
+    user = await GatewayService.resolve_user(headers)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    return user
 
 @app.get("/api/presence")
 async def list_presence_users(request: Request):
     headers = dict(request.headers)
     params = dict(request.query_params)
-    return GatewayService.forward_request("presence", "/api/v1.0.0/presence", "GET", headers, params=params)
+    await require_presence_caller(headers)
+    if not presence_table.seeded:
+        await seed_presence_table(headers)
+    return presence_table.list(params.get("status"))
+
+@app.get("/api/presence/stats")
+async def get_presence_stats(request: Request):
+    headers = dict(request.headers)
+    await require_presence_caller(headers)
+    if not presence_table.seeded:
+        await seed_presence_table(headers)
+    return presence_table.stats()
+
+async def seed_presence_table(headers: Dict):
+    try:
+        response = await GatewayService.forward_request("presence", "/api/v1.0.0/presence", "GET", headers)
+        records = json.loads(response.body) if response.status_code == 200 else None
+    except (HTTPException, ValueError) as e:
+        logger.warning(f"Could not seed the presence table: {str(e)}")
+        return
+    presence_table.seed(records)
 
 @app.get("/api/presence/{user_id}")
 async def get_user_presence(user_id: str, request: Request):
     headers = dict(request.headers)
-    return GatewayService.forward_request("presence", f"/api/v1.0.0/presence/{user_id}", "GET", headers)
+    record = presence_table.get(user_id)
+    if record is not None:
+        await require_presence_caller(headers)
+        return record
+    return await GatewayService.forward_request("presence", f"/api/v1.0.0/presence/{user_id}", "GET", headers)
 
 @app.patch("/api/presence/{user_id}")
 async def update_presence(user_id: str, request: Request):
+    # Heartbeats only touch the in-memory table, presence_table flushes them upstream in batches,
+    # so the caller is checked here: only the user itself can send its heartbeats
     headers = dict(request.headers)
-    body = await request.json() if request.method == "PATCH" else None
-    return GatewayService.forward_request("presence", f"/api/v1.0.0/presence/{user_id}", "PATCH", headers, body)
+    user = await require_presence_caller(headers)
+    if str(user.get("id")) != user_id:
+        raise HTTPException(status_code=403, detail="Cannot update the presence of another user")
+    try:
+        body = await request.json() if await request.body() else None
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Body must be a JSON object")
+    if body is not None and not isinstance(body, dict):
+        raise HTTPException(status_code=422, detail="Body must be a JSON object")
+    return presence_table.heartbeat(user_id, body, headers.get("authorization", ""))
 
 @app.delete("/api/presence/{user_id}")
 async def delete_presence(user_id: str, request: Request):
     headers = dict(request.headers)
-    return GatewayService.forward_request("presence", f"/api/v1.0.0/presence/{user_id}", "DELETE", headers)
-
-@app.get("/api/presence/stats")
-async def get_presence_stats(request: Request):
-    headers = dict(request.headers)
-    return GatewayService.forward_request("presence", "/api/v1.0.0/presence/stats", "GET", headers)
-
+    response = await GatewayService.forward_request("presence", f"/api/v1.0.0/presence/{user_id}", "DELETE", headers)
+    # Only forget the user once the presence service accepted the caller's delete
+    if response.status_code < 300:
+        presence_table.remove(user_id)
+    return response
 
 # Search service endpoints
 @app.get("/api/search/health")
@@ -377,68 +3396,67 @@ async def search_health(request: Request):
     # Test basic functionality by searching for a sample term
     if not params:
         params = {"q": "test"}
-    return GatewayService.forward_request("search", "/api/message/search_message", "GET", headers, params=params)
+    return await GatewayService.forward_request("search", "/api/message/search_message", "GET", headers, params=params)
 
 @app.get("/api/search/messages")
 async def search_messages(request: Request):
-    headers = dict(request.headers)
-    params = dict(request.query_params)
-    return GatewayService.forward_request("search", "/api/message/search_message", "GET", headers, params=params)
+    """Recent messages are searched in the gateway's message_index, older ones by the search service"""
+    return await GatewayService.search_messages(request)
 
 @app.get("/api/search/files")
 async def search_files(request: Request):
-    headers = dict(request.headers)
-    params = dict(request.query_params)
-    return GatewayService.forward_request("search", "/api/files/search_files", "GET", headers, params=params)
+    return await GatewayService.forward_search("search_files", "/api/files/search_files", request)
 
 @app.get("/api/search/channels")
 async def search_channels(request: Request):
-    headers = dict(request.headers)
-    params = dict(request.query_params)
-    return GatewayService.forward_request("search", "/api/channel/search_channel", "GET", headers, params=params)
+    return await GatewayService.forward_search("search_channels", "/api/channel/search_channel", request)
 
 @app.get("/api/search/threads/id/{thread_id}")
 async def search_threads_by_id(thread_id: str, request: Request):
     headers = dict(request.headers)
-    return GatewayService.forward_request("search", f"/api/threads/id/{thread_id}", "GET", headers)
+    return await GatewayService.forward_request("search", f"/api/threads/id/{thread_id}", "GET", headers)
 
 @app.get("/api/search/threads/author/{author}")
 async def search_threads_by_author(author: str, request: Request):
     headers = dict(request.headers)
-    return GatewayService.forward_request("search", f"/api/threads/author/{author}", "GET", headers)
+    return await GatewayService.forward_request("search", f"/api/threads/author/{author}", "GET", headers)
 
 
 # Files service endpoints
 @app.get("/api/files/health")
 async def files_health():
-    return GatewayService.forward_request("files", "/healthz", "GET", {})
+    return await GatewayService.forward_request("files", "/healthz", "GET", {})
 
 @app.get("/api/files")
 async def list_files(request: Request):
     headers = dict(request.headers)
     params = dict(request.query_params)
-    return GatewayService.forward_request("files", "/v1/files", "GET", headers, params=params)
+    return await GatewayService.forward_request("files", "/v1/files", "GET", headers, params=params)
 
 @app.post("/api/files")
 async def upload_file(request: Request):
-    # Handling multipart/form-data for file uploads would require special handling
-    # This is a simplified implementation
-    headers = dict(request.headers)
+    # Multipart uploads are piped chunk by chunk to the files service, never buffered here
     params = dict(request.query_params)
-    body = await request.json() if request.method == "POST" else None
-    return GatewayService.forward_request("files", "/v1/files", "POST", headers, body, params)
+    return await GatewayService.stream_request("files", "/v1/files", request, params)
 
+# Catch-all for file downloads and other file routes - streamed in both directions
+@app.api_route("/api/files/{path:path}", methods=["GET", "PUT", "DELETE"])
+async def proxy_files(request: Request, path: str):
+    params = dict(request.query_params)
+    return await GatewayService.stream_request("files", f"/v1/files/{path}", request, params)
 
 # Chatbot service endpoints
 @app.get("/api/chatbot/health")
 async def chatbot_health():
-    return GatewayService.forward_request("chatbot", "/health", "GET", {})
+    return await GatewayService.forward_request("chatbot", "/health", "GET", {})
 
 @app.post("/api/chatbot/chat")
 async def chatbot_chat(request: Request):
     headers = dict(request.headers)
     body = await request.json() if request.method == "POST" else None
-    return GatewayService.forward_request("chatbot", "/chat", "POST", headers, body, timeout=300)
+    if wants_stream(request):
+        return GatewayService.stream_events("chatbot", "/chat", headers, body, timeout=300)
+    return await GatewayService.forward_request("chatbot", "/chat", "POST", headers, body, timeout=300)
 
 # Wikipedia and Programming Bot Commands
 @app.post("/api/commands/wikipedia")
@@ -447,6 +3465,8 @@ async def wikipedia_command(request: Request):
     """
     Wikipedia bot command endpoint - can be used in any chat to get Wikipedia information
     Expected request body: {"message": "search term"}
+    Add ?stream=true (or Accept: text/event-stream) to get the answer as Server-Sent Events
+    Add ?async=true (or Prefer: respond-async) to get a 202 with a job id and poll /api/commands/jobs/{job_id}
     """
     if request.method == "OPTIONS":
         return JSONResponse(status_code=200, content={})
@@ -461,7 +3481,10 @@ async def wikipedia_command(request: Request):
     else:
         formatted_body = {"message": ""} # Send empty message if no body
 
-    return GatewayService.forward_request("wikipedia", "/chat-wikipedia", "POST", headers, formatted_body)
+    if wants_job(request):
+        return GatewayService.submit_command("wikipedia", "wikipedia", "/chat-wikipedia", headers, formatted_body)
+    return await GatewayService.forward_command("wikipedia", "wikipedia", "/chat-wikipedia", headers, formatted_body,
+                                                stream=wants_stream(request))
 
 
 @app.post("/api/commands/programming")
@@ -470,6 +3493,8 @@ async def programming_command(request: Request):
     """
     Programming bot with auto-completion command endpoint
     Expected request body: {"message": "code or query"}
+    Add ?stream=true (or Accept: text/event-stream) to get the answer as Server-Sent Events
+    Add ?async=true (or Prefer: respond-async) to get a 202 with a job id and poll /api/commands/jobs/{job_id}
     """
     if request.method == "OPTIONS":
         return JSONResponse(status_code=200, content={})
@@ -483,7 +3508,10 @@ async def programming_command(request: Request):
     else:
         formatted_body = {"message": ""}
 
-    return GatewayService.forward_request("chatbot", "/chat", "POST", headers, formatted_body, timeout=300)
+    if wants_job(request):
+        return GatewayService.submit_command("programming", "chatbot", "/chat", headers, formatted_body, timeout=300)
+    return await GatewayService.forward_command("programming", "chatbot", "/chat", headers, formatted_body, timeout=300,
+                                                stream=wants_stream(request))
 
 
 @app.post("/api/commands/code")
@@ -493,6 +3521,8 @@ async def code_command(request: Request):
     Code documentation command endpoint
     Forwards requests to the chatbot service for code-related queries
     Expected request body: {"message": "code query or question"}
+    Add ?stream=true (or Accept: text/event-stream) to get the answer as Server-Sent Events
+    Add ?async=true (or Prefer: respond-async) to get a 202 with a job id and poll /api/commands/jobs/{job_id}
     """
     if request.method == "OPTIONS":
         return JSONResponse(status_code=200, content={})
@@ -506,7 +3536,32 @@ async def code_command(request: Request):
     else:
         formatted_body = {"message": ""}
 
-    return GatewayService.forward_request("chatbot", "/chat", "POST", headers, formatted_body, timeout=300)
+    if wants_job(request):
+        return GatewayService.submit_command("code", "chatbot", "/chat", headers, formatted_body, timeout=300)
+    return await GatewayService.forward_command("code", "chatbot", "/chat", headers, formatted_body, timeout=300,
+                                                stream=wants_stream(request))
+
+
+@app.get("/api/commands/jobs/{job_id}")
+async def get_command_job(job_id: str, request: Request, wait: float = 0.0):
+    """
+    Result of an asynchronous bot command: the command's own response once the job is done,
+    202 with the job status while it is queued or running. ?wait=N holds the request up to N
+    seconds (at most COMMAND_JOB_MAX_WAIT_SECONDS) for the job to finish instead of polling.
+    """
+    job = command_jobs.get(job_id, dict(request.headers))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    if not job.done.is_set() and wait > 0:
+        try:
+            await asyncio.wait_for(job.done.wait(), min(wait, COMMAND_JOB_MAX_WAIT_SECONDS))
+        except asyncio.TimeoutError:
+            pass
+    if not job.done.is_set():
+        return JSONResponse(status_code=202, content=job.snapshot(), headers={"Retry-After": "1"})
+    if job.error is not None:
+        raise job.error
+    return job.response
 
 
 # Service discovery endpoint
@@ -515,11 +3570,30 @@ async def list_services():
     """List all available services"""
     return {
         "services": {
-            name: url for name, url in SERVICE_REGISTRY.items()
-        }
+            name: config["url"] for name, config in SERVICE_REGISTRY.items()
+        },
+        "circuit_breakers": GatewayService.snapshot_breakers(),
+        "bulkheads": GatewayService.snapshot_bulkheads(),
+        "command_jobs": command_jobs.snapshot()
     }
 
 
+# Response cache counters endpoint
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters of the response cache (used to tune CACHE_TTLS), the bot answer cache and the search cache"""
+    await answer_cache.refresh()
+    return {**response_cache.snapshot(), "answers": answer_cache.snapshot(), "search": search_cache.snapshot(),
+            "search_superseded": search_debouncer.superseded, "message_index": message_index.snapshot()}
+
+
+# Prometheus metrics endpoint
+@app.get("/metrics")
+async def metrics():
+    """Request counts, status codes, latencies and payload sizes per route and per upstream service"""
+    return PlainTextResponse(gateway_metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 # Note: General proxy endpoint removed - all routes should be explicitly defined above
 # This prevents conflicts with specific /api/* routes
 # If you need a general proxy, add it after all specific routes with appropriate path constraints
@@ -533,6 +3607,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
         status_code=exc.status_code,
         content={"detail": exc.detail},
         headers={
+            **(exc.headers or {}),
             "Access-Control-Allow-Origin": request.headers.get("origin", "*"),
             "Access-Control-Allow-Credentials": "true",
             "Access-Control-Allow-Methods": "GET, POST, PUT, PATCH, DELETE, OPTIONS, HEAD",
@@ -541,15 +3616,129 @@ async def http_exception_handler(request: Request, exc: HTTPException):
     )
 
 
-# Rate limiting and circuit breaker could be implemented here
+def redact_query(query: str) -> str:
+    """Query string with the values of secret-looking parameters masked"""
+    return urlencode([(key, "[REDACTED]" if SECRET_PARAM_PATTERN.search(key) else value)
+                      for key, value in parse_qsl(query, keep_blank_values=True)], safe="[]")
+
+
+def log_access(request: Request, status_code: int, duration: float, response: Optional[Response],
+               trace_id: Optional[str] = None):
+    """
+    Emit the access record of a request: errors and slow requests always, the rest sampled.
+    The record is only built for requests that get logged; headers and bodies are never included.
+    """
+    duration_ms = duration * 1000
+    slow = duration_ms >= ACCESS_LOG_SLOW_MS
+    if status_code < 400 and not slow and random.random() >= ACCESS_LOG_SAMPLE_RATE:
+        return
+
+    route = request.scope.get("route")
+    record = {
+        "method": request.method,
+        "path": request.url.path,
+        "route": route.path if route is not None else None,
+        "status": status_code,
+        "duration_ms": round(duration_ms, 1),
+        "client": RateLimiter.client_ip(request),
+        "bytes_in": request.headers.get("content-length"),
+        "bytes_out": response.headers.get("content-length") if response is not None else None,
+    }
+    if trace_id:
+        record["trace_id"] = trace_id
+    if request.url.query:
+        record["query"] = redact_query(request.url.query)
+    if request.headers.get("authorization"):
+        # Short hash of the token: enough to follow one user's requests without logging the token
+        record["user"] = ResponseCache.user_identity(request.headers)[:12]
+    if response is not None and "x-cache" in response.headers:
+        record["cache"] = response.headers["x-cache"]
+    if slow:
+        record["slow"] = True
+    elif status_code < 400:
+        record["sample_rate"] = ACCESS_LOG_SAMPLE_RATE
+
+    level = logging.WARNING if status_code >= 500 else logging.INFO
+    access_logger.log(level, "%s %s %s", request.method, request.url.path, status_code, extra={"access": record})
+
+
+# Rate limiting is enforced here (circuit breakers live in GatewayService.check_breaker)
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    """Middleware to log requests"""
-    logger.info(f"Received {request.method} request to {request.url.path}")
-    response = await call_next(request)
-    return response
+    """
+    Middleware that applies the per-user and per-IP rate limits, traces the request (Server-Timing
+    header included), records the route metrics and writes the access log
+    """
+    started = time.perf_counter()
+    gateway_metrics.in_flight += 1
+    root_span = tracer.start_trace(request.headers.get("traceparent"))
+    span_token = current_span.set(root_span)
+    response = None
+    try:
+        if RATE_LIMITING_ENABLED and request.method != "OPTIONS":
+            retry_after = rate_limiter.check(request)
+            if retry_after is not None:
+                # Exception handlers don't run for middlewares, so build the error response directly
+                response = await http_exception_handler(request, HTTPException(
+                    status_code=429,
+                    detail="Too many requests, please slow down",
+                    headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+                ))
+                return response
+        response = await call_next(request)
+        return response
+    finally:
+        gateway_metrics.in_flight -= 1
+        current_span.reset(span_token)
+        duration = time.perf_counter() - started
+        # Unhandled errors reach the client as a 500
+        status_code = response.status_code if response is not None else 500
+        gateway_metrics.observe_request(request, status_code, duration, response)
+        route = request.scope.get("route")
+        root_span.name = f"{request.method} {route.path if route is not None else 'unmatched'}"
+        server_timing = tracer.finish_trace(root_span, status_code)
+        if response is not None:
+            response.headers["Server-Timing"] = server_timing
+        log_access(request, status_code, duration, response, root_span.trace.trace_id)
+
+
+# Serving profile of `python api_gateway.py` (the Docker image runs it this way).
+# Every worker keeps its own response cache, rate limit buckets, presence table and realtime
+# subscribers, so with GATEWAY_WORKERS > 1 rate limits apply per worker and a WebSocket/SSE
+# client only gets the messages written through its own worker.
+SERVING_CONFIG = {
+    "host": os.environ.get("GATEWAY_HOST", "0.0.0.0"),
+    "port": int(os.environ.get("PORT", "8000")),
+    "workers": int(os.environ.get("GATEWAY_WORKERS", "1")),
+    # uvloop and httptools come with uvicorn[standard]
+    "loop": os.environ.get("GATEWAY_LOOP", "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"),
+    "http": os.environ.get("GATEWAY_HTTP", "httptools" if importlib.util.find_spec("httptools") else "h11"),
+    "backlog": int(os.environ.get("GATEWAY_BACKLOG", "2048")),
+    # Longer than the ingress' 60s upstream keep-alive, so the gateway never closes a connection
+    # nginx is about to reuse
+    "timeout_keep_alive": int(os.environ.get("GATEWAY_KEEPALIVE_SECONDS", "75")),
+    # On SIGTERM stop accepting connections and give in-flight requests this long to finish
+    # (open WebSocket/SSE streams are closed when it runs out)
+    "timeout_graceful_shutdown": int(os.environ.get("GATEWAY_GRACEFUL_SECONDS", "20")),
+    # Recycle a worker after this many requests (0 = never), only used with several workers
+    "limit_max_requests": int(os.environ.get("GATEWAY_MAX_REQUESTS", "0")) or None,
+}
 
 
-if __name__ == "__main__":
+def serve():
+    """Run the gateway with SERVING_CONFIG"""
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    config = dict(SERVING_CONFIG)
+    if config["workers"] > 1:
+        # The supervisor process restarts recycled workers; workers import the app themselves
+        target = "api_gateway:app"
+    else:
+        # Without a supervisor a recycled worker would take the whole gateway down
+        config["limit_max_requests"] = None
+        target = app
+    # The gateway writes its own access log (see log_access)
+    uvicorn.run(target, access_log=False, **config)
+
+
+if __name__ == "__main__":
+    serve()
\ No newline at end of file
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Local benchmark of the API gateway hot path
+Starts stand-in services for every SERVICE_REGISTRY entry (configurable latency, payload
+size and error rate), points the gateway at them and drives representative traffic:
+login, channel list, message page and bot command.
+Reports p50/p95/p99 latency, requests per second and gateway RSS per scenario as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import httpx
+
+from api_gateway import SERVICE_REGISTRY
+
+
+# Scenarios: (method, path, json body) built per request so paths and users vary like real traffic
+def scenario_login(user: int) -> tuple:
+    return "POST", "/api/users/login", {"username": f"bench_user_{user}", "password": "BenchPass123!"}
+
+def scenario_channel_list(user: int) -> tuple:
+    return "GET", "/api/channels", None
+
+def scenario_message_page(user: int) -> tuple:
+    return "GET", f"/api/messages/threads/thread-{random.randint(1, 50)}/messages", None
+
+def scenario_bot_command(user: int) -> tuple:
+    return "POST", "/api/commands/programming", {"message": f"how do I reverse a list? #{random.randint(1, 10**6)}"}
+
+SCENARIOS = {
+    "login": scenario_login,
+    "channel_list": scenario_channel_list,
+    "message_page": scenario_message_page,
+    "bot_command": scenario_bot_command,
+}
+
+
+class StubServices:
+    """Stand-in upstreams: one raw ASGI app per service, each on its own port"""
+
+    def __init__(self, base_port: int, latency_ms: float, payload_bytes: int, error_rate: float,
+                 bot_latency_ms: float):
+        self.base_port = base_port
+        self.latency_ms = latency_ms
+        self.payload_bytes = payload_bytes
+        self.error_rate = error_rate
+        self.bot_latency_ms = bot_latency_ms
+
+    def ports(self) -> Dict[str, int]:
+        return {name: self.base_port + index for index, name in enumerate(SERVICE_REGISTRY)}
+
+    def build_payload(self) -> bytes:
+        """JSON list of fake messages padded to roughly payload_bytes"""
+        item = {"id": "0" * 36, "thread_id": "thread-1", "user_id": "bench", "content": "x" * 120,
+                "created_at": "2026-01-01T00:00:00Z"}
+        item_size = len(json.dumps(item)) + 2
+        return json.dumps([item] * max(1, self.payload_bytes // item_size)).encode()
+
+    def make_app(self, service_name: str):
+        payload = self.build_payload()
+        latency = (self.bot_latency_ms if service_name in ("chatbot", "wikipedia") else self.latency_ms) / 1000
+        error_body = b'{"detail": "stub error"}'
+
+        async def app(scope, receive, send):
+            if scope["type"] == "lifespan":
+                while True:
+                    message = await receive()
+                    if message["type"] == "lifespan.startup":
+                        await send({"type": "lifespan.startup.complete"})
+                    elif message["type"] == "lifespan.shutdown":
+                        await send({"type": "lifespan.shutdown.complete"})
+                        return
+            # Drain the request body before answering
+            more_body = True
+            while more_body:
+                message = await receive()
+                more_body = message.get("more_body", False)
+            if latency:
+                await asyncio.sleep(random.uniform(0.8, 1.2) * latency)
+            failed = random.random() < self.error_rate
+            body = error_body if failed else payload
+            await send({"type": "http.response.start", "status": 500 if failed else 200,
+                        "headers": [(b"content-type", b"application/json"),
+                                    (b"content-length", str(len(body)).encode())]})
+            await send({"type": "http.response.body", "body": body})
+
+        return app
+
+    async def serve(self):
+        import uvicorn
+        servers = [
+            uvicorn.Server(uvicorn.Config(self.make_app(name), host="127.0.0.1", port=port,
+                                          log_level="warning", access_log=False))
+            for name, port in self.ports().items()
+        ]
+        await asyncio.gather(*(server.serve() for server in servers))
+
+
+def read_rss_mb(pid: int) -> Optional[float]:
+    """Resident set size of a process and its children (the workers) in MiB (Linux only, None elsewhere)"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            rss_kb = next(int(line.split()[1]) for line in status if line.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            child_pids = [int(child) for child in children.read().split()]
+    except (OSError, StopIteration):
+        return None
+    rss_mb = rss_kb / 1024
+    for child_pid in child_pids:
+        rss_mb += read_rss_mb(child_pid) or 0.0
+    return round(rss_mb, 1)
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class GatewayBenchmark:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.gateway_url = f"http://127.0.0.1:{args.gateway_port}"
+        self.stubs = StubServices(args.stub_base_port, args.latency_ms, args.payload_bytes,
+                                  args.error_rate, args.bot_latency_ms)
+        self.processes: List[subprocess.Popen] = []
+
+    def start(self) -> subprocess.Popen:
+        """Start the stand-ins and a gateway pointed at them, returning the gateway process"""
+        stub_args = [sys.executable, __file__, "--serve-stubs",
+                     "--stub-base-port", str(self.args.stub_base_port),
+                     "--latency-ms", str(self.args.latency_ms),
+                     "--bot-latency-ms", str(self.args.bot_latency_ms),
+                     "--payload-bytes", str(self.args.payload_bytes),
+                     "--error-rate", str(self.args.error_rate)]
+        self.processes.append(subprocess.Popen(stub_args, stdout=subprocess.DEVNULL))
+
+        # The gateway runs with its production serving profile (SERVING_CONFIG)
+        env = dict(os.environ, RATE_LIMITING_ENABLED="false", GATEWAY_HOST="127.0.0.1",
+                   PORT=str(self.args.gateway_port), GATEWAY_WORKERS=str(self.args.workers))
+        if self.args.loop:
+            env["GATEWAY_LOOP"] = self.args.loop
+        if self.args.http:
+            env["GATEWAY_HTTP"] = self.args.http
+        for name, port in self.stubs.ports().items():
+            env[f"{name.upper()}_SERVICE_URL"] = f"http://127.0.0.1:{port}"
+        gateway = subprocess.Popen([sys.executable, "api_gateway.py"], env=env,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.processes.append(gateway)
+        return gateway
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    async def wait_ready(self, client: httpx.AsyncClient, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        ports = list(self.stubs.ports().values())
+        while time.monotonic() < deadline:
+            try:
+                await client.get(f"{self.gateway_url}/health")
+                for port in ports:
+                    await client.get(f"http://127.0.0.1:{port}/")
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+        raise RuntimeError("Gateway or stand-in services did not start in time")
+
+    async def run_scenario(self, client: httpx.AsyncClient, name: str, gateway_pid: int) -> Dict:
+        build_request = SCENARIOS[name]
+        latencies: List[float] = []
+        statuses: Dict[str, int] = {}
+        peak_rss = read_rss_mb(gateway_pid)
+        deadline = time.monotonic() + self.args.duration
+
+        async def virtual_user(user: int):
+            headers = {"Authorization": f"Bearer bench-token-{user}"}
+            while time.monotonic() < deadline:
+                method, path, body = build_request(user)
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, f"{self.gateway_url}{path}", json=body, headers=headers)
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append((time.perf_counter() - started) * 1000)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        async def sample_rss():
+            nonlocal peak_rss
+            while time.monotonic() < deadline:
+                rss = read_rss_mb(gateway_pid)
+                if rss is not None and (peak_rss is None or rss > peak_rss):
+                    peak_rss = rss
+                await asyncio.sleep(0.25)
+
+        started = time.perf_counter()
+        await asyncio.gather(sample_rss(), *(virtual_user(user) for user in range(self.args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "statuses": statuses,
+            "rps": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50), 2),
+            "p95_ms": round(percentile(latencies, 0.95), 2),
+            "p99_ms": round(percentile(latencies, 0.99), 2),
+            "max_ms": round(latencies[-1], 2) if latencies else 0.0,
+            "rss_mb": read_rss_mb(gateway_pid),
+            "peak_rss_mb": peak_rss,
+        }
+
+    async def run(self) -> Dict:
+        gateway = self.start()
+        try:
+            limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+            async with httpx.AsyncClient(limits=limits, timeout=60.0) as client:
+                await self.wait_ready(client)
+                results = {}
+                for name in self.args.scenarios:
+                    print(f"Running {name} ({self.args.concurrency} users, {self.args.duration}s)...", file=sys.stderr)
+                    results[name] = await self.run_scenario(client, name, gateway.pid)
+        finally:
+            self.stop()
+
+        return {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "config": {key: value for key, value in vars(self.args).items() if key not in ("output", "serve_stubs")},
+            "scenarios": results,
+        }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the API gateway against local stand-in services")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=50, help="Concurrent virtual users")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Stand-in latency (+/-20%% jitter)")
+    parser.add_argument("--bot-latency-ms", type=float, default=500.0, help="Latency of the chatbot/wikipedia stand-ins")
+    parser.add_argument("--payload-bytes", type=int, default=4096, help="Size of the stand-in JSON responses")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of stand-in responses that are 500s")
+    parser.add_argument("--workers", type=int, default=1, help="Gateway worker processes (GATEWAY_WORKERS)")
+    parser.add_argument("--loop", choices=["uvloop", "asyncio"], help="Gateway event loop (default: serving profile)")
+    parser.add_argument("--http", choices=["httptools", "h11"], help="Gateway HTTP parser (default: serving profile)")
+    parser.add_argument("--gateway-port", type=int, default=18000)
+    parser.add_argument("--stub-base-port", type=int, default=18100)
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--serve-stubs", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.serve_stubs:
+        stubs = StubServices(args.stub_base_port, args.latency_ms, args.payload_bytes,
+                             args.error_rate, args.bot_latency_ms)
+        asyncio.run(stubs.serve())
+        return
+
+    results = asyncio.run(GatewayBenchmark(args).run())
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,13 @@ import time
 import random
 import string
 import requests
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 
@@ -59,11 +66,21 @@ class Colors:
 
 
 class PlaywrightTestRunner:
+    # Independent E2E flows. Each one registers its own user, so they can run in parallel
+    FLOWS = {
+        "messaging": ["test_register", "test_login", "test_create_channel", "test_create_thread",
+                      "test_send_wikipedia_and_code_message"],
+        "navigation": ["test_register", "test_login", "test_navigation_and_ui"],
+        "responsive": ["test_register", "test_login", "test_responsive_design"],
+    }
+
     def __init__(self):
         self.base_url = "https://grupo12.inf326.nursoft.dev"
         self.total_tests = 0
         self.passed_tests = 0
         self.failed_tests = 0
+        # (test method, seconds, passed) of every test run
+        self.timings = []
 
         # Generate unique user credentials for this test run
         random_suffix = ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
@@ -86,6 +103,24 @@ class PlaywrightTestRunner:
             if error_msg:
                 print(f"     Error: {error_msg}")
 
+    def timed(self, test, page: Page) -> bool:
+        """Run a test method and record how long it took"""
+        started = time.perf_counter()
+        result = test(page)
+        elapsed = time.perf_counter() - started
+        self.timings.append((test.__name__, elapsed, result))
+        print(f"     ({elapsed:.1f}s)")
+        return result
+
+    def open_page(self, p):
+        """Launch a headless browser and return (browser, context, page)"""
+        browser = p.chromium.launch(headless=True)
+        context = browser.new_context(
+            viewport={"width": 1920, "height": 1080},
+            user_agent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"
+        )
+        return browser, context, context.new_page()
+
     def test_register(self, page: Page) -> bool:
         """Test user registration"""
         try:
@@ -403,47 +438,42 @@ class PlaywrightTestRunner:
         with sync_playwright() as p:
             # Launch browser in headless mode
             print(f"{Colors.info('Launching browser...')}")
-            browser = p.chromium.launch(headless=True)
-            context = browser.new_context(
-                viewport={"width": 1920, "height": 1080},
-                user_agent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"
-            )
-            page = context.new_page()
+            browser, context, page = self.open_page(p)
 
             try:
                 # Run all tests in sequence
                 test_results = []
 
                 # Test 1: Register
-                result = self.test_register(page)
+                result = self.timed(self.test_register, page)
                 test_results.append(result)
 
                 if result:
                     # Test 2: Login
-                    result = self.test_login(page)
+                    result = self.timed(self.test_login, page)
                     test_results.append(result)
 
                     if result:
                         # Test 3: Create Channel
-                        result = self.test_create_channel(page)
+                        result = self.timed(self.test_create_channel, page)
                         test_results.append(result)
 
                         if result:
                             # Test 4: Create Thread
-                            result = self.test_create_thread(page)
+                            result = self.timed(self.test_create_thread, page)
                             test_results.append(result)
 
                             if result:
                                 # Test 5: Send Wikipedia and Code Messages
-                                result = self.test_send_wikipedia_and_code_message(page)
+                                result = self.timed(self.test_send_wikipedia_and_code_message, page)
                                 test_results.append(result)
 
                         # Test 6: Navigation (independent)
-                        result = self.test_navigation_and_ui(page)
+                        result = self.timed(self.test_navigation_and_ui, page)
                         test_results.append(result)
 
                         # Test 7: Responsive Design (independent)
-                        result = self.test_responsive_design(page)
+                        result = self.timed(self.test_responsive_design, page)
                         test_results.append(result)
 
             finally:
@@ -452,7 +482,72 @@ class PlaywrightTestRunner:
                 browser.close()
                 print(f"\n{Colors.info('Browser closed.')}")
 
-        # Print summary
+        return self.print_summary()
+
+    def run_flow(self, flow_name: str) -> bool:
+        """Run one flow in its own browser, a failed step skips the rest of the flow"""
+        with sync_playwright() as p:
+            browser, context, page = self.open_page(p)
+            try:
+                for test_name in self.FLOWS[flow_name]:
+                    if not self.timed(getattr(self, test_name), page):
+                        return False
+                return True
+            finally:
+                page.close()
+                context.close()
+                browser.close()
+
+    def run_parallel(self, workers: int = 3, shard: Optional[str] = None, fail_fast: bool = False) -> bool:
+        """
+        Run the flows in parallel worker processes, each with its own browser.
+        shard "i/n" only runs every n-th flow starting at the i-th (to split them across machines),
+        fail_fast stops the remaining flows after the first failure.
+        """
+        flows = list(self.FLOWS)
+        if shard:
+            index, count = (int(part) for part in shard.split("/"))
+            flows = flows[index - 1::count]
+
+        print(f"\n{Colors.box_top(60)}")
+        print(Colors.box_line("PLAYWRIGHT E2E TESTS - Parallel", 60))
+        print(Colors.box_line(f"Base URL: {self.base_url}", 60))
+        print(Colors.box_line(f"Flows: {', '.join(flows) or 'none'}", 60))
+        print(Colors.box_line(f"Workers: {workers}" + (f", shard: {shard}" if shard else ""), 60))
+        print(f"{Colors.box_bottom(60)}\n")
+
+        started = time.perf_counter()
+        all_passed = True
+        # spawn: the Playwright sync API can't be used from a forked process
+        with multiprocessing.get_context("spawn").Pool(processes=max(1, min(workers, len(flows)))) as pool:
+            for result in pool.imap_unordered(run_e2e_flow, flows):
+                print(f"\n{Colors.info('#' * 60)}")
+                flow_title = f"FLOW: {result['flow'].upper()} ({result['seconds']:.1f}s)"
+                print(f"{Colors.info(flow_title)}")
+                print(f"{Colors.info('#' * 60)}")
+                print(result["output"], end="")
+
+                self.total_tests += result["total_tests"]
+                self.passed_tests += result["passed_tests"]
+                self.failed_tests += result["failed_tests"]
+                self.timings.extend(result["timings"])
+                all_passed = all_passed and result["passed"]
+
+                if fail_fast and not result["passed"]:
+                    print(f"\n{Colors.warning('Fail-fast: stopping the remaining flows')}")
+                    pool.terminate()
+                    break
+
+        print(f"\n{Colors.info('Test timings (slowest first):')}")
+        for test_name, seconds, passed in sorted(self.timings, key=lambda timing: -timing[1]):
+            mark = Colors.success("✓") if passed else Colors.error("✗")
+            print(f"  {mark} {test_name:<45} {seconds:6.1f}s")
+        print(f"  Wall time: {time.perf_counter() - started:.1f}s")
+
+        return self.print_summary() and all_passed
+
+    def print_summary(self) -> bool:
+        """Print the summary box, returning whether every test passed"""
         print(f"\n{Colors.box_top(60)}")
         print(Colors.box_line("TEST SUMMARY", 60))
         print(Colors.box_separator(60))
@@ -477,11 +572,34 @@ class PlaywrightTestRunner:
         return self.passed_tests == self.total_tests
 
 
+def run_e2e_flow(flow_name: str) -> dict:
+    """Worker process entry point: run one E2E flow and return its captured output and results"""
+    runner = PlaywrightTestRunner()
+    output = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        try:
+            passed = runner.run_flow(flow_name)
+        except Exception as e:
+            runner.log_test(f"Flow {flow_name}", "FAIL", str(e))
+            passed = False
+    return {
+        "flow": flow_name,
+        "passed": passed,
+        "seconds": time.perf_counter() - started,
+        "output": output.getvalue(),
+        "total_tests": runner.total_tests,
+        "passed_tests": runner.passed_tests,
+        "failed_tests": runner.failed_tests,
+        "timings": runner.timings,
+    }
+
+
 class APIGatewayTestRunner:
     """Test API Gateway endpoints"""
 
-    def __init__(self):
-        self.base_url = "https://grupo12-api.inf326.nursoft.dev"
+    def __init__(self, base_url: Optional[str] = None):
+        self.base_url = base_url or "https://grupo12-api.inf326.nursoft.dev"
         self.total_tests = 0
         self.passed_tests = 0
         self.failed_tests = 0
@@ -704,19 +822,183 @@ class APIGatewayTestRunner:
         return self.passed_tests == self.total_tests
 
 
+class LoadVirtualUser(APIGatewayTestRunner):
+    """API test runner that keeps the outcome of the last test instead of printing it"""
+
+    def __init__(self, base_url: Optional[str] = None):
+        super().__init__(base_url)
+        self.last_error = None
+
+    def log_test(self, test_name: str, status: str, error_msg: Optional[str] = None):
+        self.last_error = None if status == "PASS" else (error_msg or test_name)
+
+
+class LoadTestRunner:
+    """
+    Run the APIGatewayTestRunner scenarios as concurrent virtual users.
+    Each virtual user repeats the journey (register -> login -> ... ) with fresh credentials
+    until the duration is over; a failed step ends the current journey like in run_all_tests.
+    """
+
+    # Load scenario name -> APIGatewayTestRunner method, in journey order
+    SCENARIOS = {
+        "health": "test_gateway_health",
+        "register": "test_api_register",
+        "login": "test_api_login",
+        "get_user_me": "test_api_get_user_me",
+        "create_channel": "test_api_create_channel",
+        "wikipedia": "test_api_wikipedia",
+        "cide": "test_api_cide",
+    }
+    DEFAULT_SCENARIOS = ["register", "login", "get_user_me", "create_channel"]
+
+    # Upper bounds (ms) of the latency histogram buckets
+    HISTOGRAM_BUCKETS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+    def __init__(self, base_url: Optional[str] = None, users: int = 10, duration: float = 60.0,
+                 ramp_up: float = 10.0, scenarios: Optional[list] = None):
+        self.base_url = base_url or APIGatewayTestRunner().base_url
+        self.users = users
+        self.duration = duration
+        self.ramp_up = ramp_up
+        self.scenarios = scenarios or self.DEFAULT_SCENARIOS
+        # (scenario, latency_ms, error or None) - list.append is thread safe
+        self.samples = []
+        self.journeys = 0
+        self._journeys_lock = threading.Lock()
+
+    def virtual_user(self, index: int, deadline: float):
+        # Spread the start of the users evenly over the ramp-up period
+        time.sleep(self.ramp_up * index / self.users)
+        while time.monotonic() < deadline:
+            user = LoadVirtualUser(self.base_url)
+            for scenario in self.scenarios:
+                started = time.perf_counter()
+                passed = getattr(user, self.SCENARIOS[scenario])()
+                self.samples.append((scenario, (time.perf_counter() - started) * 1000, user.last_error))
+                if not passed or time.monotonic() >= deadline:
+                    break
+            else:
+                with self._journeys_lock:
+                    self.journeys += 1
+
+    def run(self) -> dict:
+        """Run the load test and return its report"""
+        print(f"\n{Colors.box_top(60)}")
+        print(Colors.box_line("API GATEWAY LOAD TEST", 60))
+        print(Colors.box_line(f"Base URL: {self.base_url}", 60))
+        print(Colors.box_line(f"Users: {self.users}, ramp-up: {self.ramp_up}s, duration: {self.duration}s", 60))
+        print(Colors.box_line(f"Scenarios: {', '.join(self.scenarios)}", 60))
+        print(f"{Colors.box_bottom(60)}\n")
+        print(f"{Colors.info('Running virtual users...')}")
+
+        started = time.monotonic()
+        deadline = started + self.ramp_up + self.duration
+        # The test methods print their progress, silence them while the users run
+        with contextlib.redirect_stdout(io.StringIO()):
+            with ThreadPoolExecutor(max_workers=self.users) as executor:
+                list(executor.map(lambda index: self.virtual_user(index, deadline), range(self.users)))
+        elapsed = time.monotonic() - started
+
+        report = self.build_report(elapsed)
+        self.print_report(report)
+        return report
+
+    def build_report(self, elapsed: float) -> dict:
+        report = {"base_url": self.base_url, "users": self.users, "ramp_up": self.ramp_up,
+                  "duration": self.duration, "elapsed": round(elapsed, 1),
+                  "requests": len(self.samples), "journeys": self.journeys,
+                  "throughput_rps": round(len(self.samples) / elapsed, 2) if elapsed else 0.0,
+                  "scenarios": {}}
+        for scenario in self.scenarios:
+            latencies = sorted(latency for name, latency, _ in self.samples if name == scenario)
+            errors = {}
+            for name, _, error in self.samples:
+                if name == scenario and error:
+                    errors[error[:80]] = errors.get(error[:80], 0) + 1
+            histogram = {f"<={bound}ms": 0 for bound in self.HISTOGRAM_BUCKETS}
+            histogram[f">{self.HISTOGRAM_BUCKETS[-1]}ms"] = 0
+            for latency in latencies:
+                bucket = next((bound for bound in self.HISTOGRAM_BUCKETS if latency <= bound), None)
+                histogram[f"<={bucket}ms" if bucket else f">{self.HISTOGRAM_BUCKETS[-1]}ms"] += 1
+
+            def percentile(fraction):
+                return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))], 1) if latencies else 0.0
+
+            report["scenarios"][scenario] = {
+                "requests": len(latencies),
+                "errors": sum(errors.values()),
+                "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+                "p50_ms": percentile(0.50),
+                "p95_ms": percentile(0.95),
+                "p99_ms": percentile(0.99),
+                "max_ms": round(latencies[-1], 1) if latencies else 0.0,
+                "histogram": histogram,
+                "error_breakdown": errors,
+            }
+        return report
+
+    def print_report(self, report: dict):
+        for scenario, stats in report["scenarios"].items():
+            print(f"\n{Colors.info('='*60)}")
+            print(f"{Colors.info(f'SCENARIO: {scenario.upper()}')}")
+            print(f"{Colors.info('='*60)}")
+            print(f"  Requests: {stats['requests']}  ({stats['rps']} req/s)")
+            print(f"  Latency p50: {stats['p50_ms']}ms  p95: {stats['p95_ms']}ms  "
+                  f"p99: {stats['p99_ms']}ms  max: {stats['max_ms']}ms")
+            largest = max(stats["histogram"].values()) or 1
+            for label, count in stats["histogram"].items():
+                print(f"  {label:>10} {'█' * round(30 * count / largest):<30} {count}")
+            errors_text = f"Errors: {stats['errors']}"
+            if stats["errors"]:
+                print(f"  {Colors.error(errors_text)}")
+                for error, count in stats["error_breakdown"].items():
+                    print(f"     {count} x {error}")
+            else:
+                print(f"  {Colors.success(errors_text)}")
+
+        print(f"\n{Colors.box_top(60)}")
+        print(Colors.box_line("LOAD TEST SUMMARY", 60))
+        print(Colors.box_separator(60))
+        print(Colors.box_line(f"Requests: {report['requests']} in {report['elapsed']}s", 60))
+        print(Colors.box_line(f"Throughput: {report['throughput_rps']} req/s", 60))
+        print(Colors.box_line(f"Completed journeys: {report['journeys']}", 60))
+        total_errors = sum(stats["errors"] for stats in report["scenarios"].values())
+        errors_text = f"Errors: {total_errors}"
+        print(Colors.box_line(Colors.error(errors_text) if total_errors else Colors.success(errors_text), 60))
+        print(f"{Colors.box_bottom(60)}\n")
+
+
 def main():
     """Main entry point"""
-    import sys
+    parser = argparse.ArgumentParser(description="Playwright E2E, API and load tests")
+    parser.add_argument("--e2e", action="store_true", help="Only run the E2E tests")
+    parser.add_argument("--api", action="store_true", help="Only run the API tests")
+    parser.add_argument("--load", action="store_true", help="Run the API scenarios as a load test")
+    parser.add_argument("--base-url", help="Gateway base URL for the API and load tests")
+    parser.add_argument("--users", type=int, default=10, help="Load test: concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=60.0, help="Load test: seconds at full load")
+    parser.add_argument("--ramp-up", type=float, default=10.0, help="Load test: seconds to start all users")
+    parser.add_argument("--scenarios", nargs="+", choices=list(LoadTestRunner.SCENARIOS),
+                        help="Load test: scenarios of each journey, in order")
+    parser.add_argument("--output", help="Load test: also write the report as JSON to this file")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="E2E: run the independent flows in this many parallel browser processes")
+    parser.add_argument("--shard", help="E2E: only run shard i/n of the flows (e.g. 1/2), implies parallel mode")
+    parser.add_argument("--fail-fast", action="store_true", help="E2E: stop the remaining flows after a failure")
+    args = parser.parse_args()
+
+    if args.load:
+        report = LoadTestRunner(args.base_url, args.users, args.duration, args.ramp_up, args.scenarios).run()
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(report, file, indent=2)
+        total_errors = sum(stats["errors"] for stats in report["scenarios"].values())
+        exit(0 if report["requests"] and not total_errors else 1)
 
     # Check if user wants to run only E2E tests, only API tests, or both
-    run_e2e = True
-    run_api = True
-
-    if len(sys.argv) > 1:
-        if sys.argv[1] == "--e2e":
-            run_api = False
-        elif sys.argv[1] == "--api":
-            run_e2e = False
+    run_e2e = not args.api
+    run_api = not args.e2e
 
     e2e_success = True
     api_success = True
@@ -727,10 +1009,13 @@ def main():
 
     if run_e2e:
         e2e_runner = PlaywrightTestRunner()
-        e2e_success = e2e_runner.run_all_tests()
+        if args.workers > 1 or args.shard:
+            e2e_success = e2e_runner.run_parallel(args.workers, args.shard, args.fail_fast)
+        else:
+            e2e_success = e2e_runner.run_all_tests()
 
     if run_api:
-        api_runner = APIGatewayTestRunner()
+        api_runner = APIGatewayTestRunner(args.base_url)
         api_success = api_runner.run_all_tests()
 
     # Print combined test results summary
@@ -85,8 +85,8 @@ const apiService = {
 
   // Search service
   search: {
-    messages: (params) => apiClient.get('/api/search/messages', { params }),
-    files: (params) => apiClient.get('/api/search/files', { params }),
+    messages: (params, config = {}) => apiClient.get('/api/search/messages', { params, ...config }),
+    files: (params, config = {}) => apiClient.get('/api/search/files', { params, ...config }),
     channels: (params) => apiClient.get('/api/search/channels', { params }),
     threadsById: (threadId) => apiClient.get(`/api/search/threads/id/${threadId}`),
     threadsByAuthor: (author) => apiClient.get(`/api/search/threads/author/${author}`),
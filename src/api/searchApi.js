@@ -1,7 +1,11 @@
 import apiService from './apiService';
 
+// Sent with the searches of one search box (see useSearch), so the gateway only drops a search
+// when a newer one from the same box replaces it
+const searchClientConfig = (clientId) => (clientId ? { headers: { 'X-Search-Client': clientId } } : {});
+
 // General search across messages, threads, and files
-export const searchContent = async (query, channelId = null, threadId = null, authorId = null, index = 0, limit = 20, offset = 0) => {
+export const searchContent = async (query, channelId = null, threadId = null, authorId = null, index = 0, limit = 20, offset = 0, clientId = null) => {
   try {
     const params = {
       q: query,
@@ -13,7 +17,7 @@ export const searchContent = async (query, channelId = null, threadId = null, au
       offset,
     };
     // Using the messages search as general search endpoint
-    const response = await apiService.search.messages(params);
+    const response = await apiService.search.messages(params, searchClientConfig(clientId));
     return response.data;
   } catch (error) {
     console.error('Error searching content:', error);
@@ -22,7 +26,7 @@ export const searchContent = async (query, channelId = null, threadId = null, au
 };
 
 // Search messages
-export const searchMessages = async (query, authorId = null, threadId = null, messageId = null, limit = 20, offset = 0) => {
+export const searchMessages = async (query, authorId = null, threadId = null, messageId = null, limit = 20, offset = 0, clientId = null) => {
   try {
     const params = {
       q: query,
@@ -32,7 +36,7 @@ export const searchMessages = async (query, authorId = null, threadId = null, me
       limit,
       offset,
     };
-    const response = await apiService.search.messages(params);
+    const response = await apiService.search.messages(params, searchClientConfig(clientId));
     return response.data;
   } catch (error) {
     console.error('Error searching messages:', error);
@@ -41,7 +45,7 @@ export const searchMessages = async (query, authorId = null, threadId = null, me
 };
 
 // Search files
-export const searchFiles = async (query, threadId = null, messageId = null, pagesMin = null, pagesMax = null, limit = 20, offset = 0) => {
+export const searchFiles = async (query, threadId = null, messageId = null, pagesMin = null, pagesMax = null, limit = 20, offset = 0, clientId = null) => {
   try {
     const params = {
       q: query,
@@ -52,7 +56,7 @@ export const searchFiles = async (query, threadId = null, messageId = null, page
       limit,
       offset,
     };
-    const response = await apiService.search.files(params);
+    const response = await apiService.search.files(params, searchClientConfig(clientId));
     return response.data;
   } catch (error) {
     console.error('Error searching files:', error);
@@ -1,80 +1,82 @@
-import { useState } from 'react';
+import { useRef, useState } from 'react';
 import { searchContent, searchMessages, searchFiles } from '../api/searchApi';
 
+// Detail of the 409 the gateway answers a search with when a newer one from the same hook replaced it
+const SUPERSEDED_DETAIL = 'Superseded by a newer search';
+
+const newClientId = () => (globalThis.crypto?.randomUUID
+  ? globalThis.crypto.randomUUID()
+  : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`);
+
 export const useSearch = () => {
   const [results, setResults] = useState([]);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
+  // Id of the latest search: answers to older ones (typed over) are ignored
+  const latestSearch = useRef(0);
+  // X-Search-Client id of this hook instance: other tabs and components don't supersede its searches
+  const clientId = useRef(null);
+  if (clientId.current === null) {
+    clientId.current = newClientId();
+  }
 
-  const search = async (query, options = {}) => {
+  const runSearch = async (request) => {
+    const searchId = ++latestSearch.current;
     setLoading(true);
     setError(null);
     try {
-      const data = await searchContent(
-        query,
-        options.channelId,
-        options.threadId,
-        options.authorId,
-        options.index,
-        options.limit,
-        options.offset
-      );
-      setResults(data.results || []);
+      const data = await request();
+      if (searchId === latestSearch.current) {
+        setResults(data.results || []);
+      }
     } catch (err) {
+      if (searchId !== latestSearch.current || err?.detail === SUPERSEDED_DETAIL) {
+        return;
+      }
       console.error('Search error:', err);
       setError(err);
       setResults([]);
     } finally {
-      setLoading(false);
+      if (searchId === latestSearch.current) {
+        setLoading(false);
+      }
     }
   };
 
-  const searchMessagesByQuery = async (query, options = {}) => {
-    setLoading(true);
-    setError(null);
-    try {
-      const data = await searchMessages(
-        query,
-        options.authorId,
-        options.threadId,
-        options.messageId,
-        options.limit,
-        options.offset
-      );
-      setResults(data.results || []);
-    } catch (err) {
-      console.error('Search error:', err);
-      setError(err);
-      setResults([]);
-    } finally {
-      setLoading(false);
-    }
-  };
+  const search = (query, options = {}) => runSearch(() => searchContent(
+    query,
+    options.channelId,
+    options.threadId,
+    options.authorId,
+    options.index,
+    options.limit,
+    options.offset,
+    clientId.current
+  ));
 
-  const searchFilesByQuery = async (query, options = {}) => {
-    setLoading(true);
-    setError(null);
-    try {
-      const data = await searchFiles(
-        query,
-        options.threadId,
-        options.messageId,
-        options.pagesMin,
-        options.pagesMax,
-        options.limit,
-        options.offset
-      );
-      setResults(data.results || []);
-    } catch (err) {
-      console.error('Search error:', err);
-      setError(err);
-      setResults([]);
-    } finally {
-      setLoading(false);
-    }
-  };
+  const searchMessagesByQuery = (query, options = {}) => runSearch(() => searchMessages(
+    query,
+    options.authorId,
+    options.threadId,
+    options.messageId,
+    options.limit,
+    options.offset,
+    clientId.current
+  ));
+
+  const searchFilesByQuery = (query, options = {}) => runSearch(() => searchFiles(
+    query,
+    options.threadId,
+    options.messageId,
+    options.pagesMin,
+    options.pagesMax,
+    options.limit,
+    options.offset,
+    clientId.current
+  ));
 
   const clearResults = () => {
+    latestSearch.current += 1;
     setResults([]);
     setError(null);
   };
@@ -0,0 +1,86 @@
+"""
+Shared fixtures: the gateway app with fresh in-memory state and every upstream service replaced
+by an httpx.MockTransport, so the tests run without network access
+"""
+import inspect
+import os
+import sys
+import threading
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_gateway  # noqa: E402
+from api_gateway import GatewayService  # noqa: E402
+
+
+class Upstream:
+    """
+    Stand-in for all the services: every request is recorded and answered by handler(request),
+    which may be a coroutine function and returns an httpx.Response
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.handler = lambda request: httpx.Response(404, json={"detail": "Not Found"})
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        response = self.handler(request)
+        if inspect.isawaitable(response):
+            response = await response
+        # fetch reads the raw stream, which a Response built from content=/json= has already consumed
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=httpx.ByteStream(response.content))
+
+    def calls(self, method: str, path: str) -> int:
+        return sum(1 for request in self.requests if request.method == method and request.url.path == path)
+
+
+async def wait_for(event: threading.Event, timeout: float = 5.0):
+    """Hold an upstream answer until the test thread sets event"""
+    deadline = time.monotonic() + timeout
+    while not event.is_set():
+        if time.monotonic() > deadline:
+            raise TimeoutError("the test never released the upstream answer")
+        await api_gateway.asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def upstream() -> Upstream:
+    return Upstream()
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path, upstream):
+    """TestClient of the gateway (one event loop for the whole test), rate limiting off"""
+    gateway = api_gateway
+    monkeypatch.setattr(gateway, "RATE_LIMITING_ENABLED", False)
+    monkeypatch.setattr(gateway, "response_cache", gateway.ResponseCache(gateway.CACHE_TTLS))
+    monkeypatch.setattr(gateway, "answer_cache", gateway.AnswerCache(
+        str(tmp_path / "answers.sqlite3"), gateway.ANSWER_CACHE_MAX_BYTES, gateway.ANSWER_CACHE_COMMANDS))
+    monkeypatch.setattr(gateway, "command_jobs", gateway.CommandJobs(
+        gateway.COMMAND_JOB_WORKERS, gateway.COMMAND_JOB_MAX_QUEUE, gateway.COMMAND_JOB_TTL_SECONDS))
+    monkeypatch.setattr(gateway, "search_cache", gateway.SearchCache(
+        gateway.SEARCH_CACHE_TTLS, gateway.SEARCH_CACHE_MAX_ENTRIES))
+    monkeypatch.setattr(gateway, "search_debouncer", gateway.SearchDebouncer())
+    monkeypatch.setattr(gateway, "rate_limiter", gateway.RateLimiter(gateway.RATE_LIMITS))
+    monkeypatch.setattr(gateway, "presence_table", gateway.PresenceTable())
+    monkeypatch.setattr(gateway, "message_hub", gateway.MessageHub())
+    monkeypatch.setattr(gateway, "message_index", gateway.MessageIndex(
+        gateway.MESSAGE_INDEX_WINDOW_SECONDS, gateway.MESSAGE_INDEX_MAX_PER_THREAD, gateway.MESSAGE_INDEX_MAX_MESSAGES))
+    monkeypatch.setattr(gateway, "tracer", gateway.Tracer())
+
+    transport = httpx.MockTransport(upstream)
+    monkeypatch.setattr(GatewayService, "_clients",
+                        {name: httpx.AsyncClient(transport=transport) for name in gateway.SERVICE_REGISTRY})
+    for name in ("_inflight", "_inflight_generations", "_breakers", "_class_bulkheads", "_service_bulkheads"):
+        monkeypatch.setattr(GatewayService, name, {})
+    monkeypatch.setattr(GatewayService, "_deep_health", None)
+
+    with TestClient(gateway.app) as test_client:
+        yield test_client
@@ -0,0 +1,46 @@
+"""Per-service circuit breakers: open on failures, fail fast, probe half-open, close on success"""
+import httpx
+
+from api_gateway import CircuitBreaker, GatewayService
+
+
+def test_breaker_opens_then_half_opens_and_closes(client, upstream):
+    status = {"code": 503}
+    upstream.handler = lambda request: httpx.Response(status["code"], json={"id": request.url.path})
+    config = GatewayService.get_service_config("channels")
+
+    # Enough failures in the window open the circuit
+    for i in range(config["breaker_min_calls"]):
+        assert client.get(f"/api/channels/c{i}").status_code == 503
+    breaker = GatewayService.get_breaker("channels")
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # While open, calls fail fast without reaching the service
+    sent = len(upstream.requests)
+    response = client.get("/api/channels/fast")
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) > 0
+    assert len(upstream.requests) == sent
+
+    # Once open_seconds have passed, probes go through and enough successes close the circuit
+    status["code"] = 200
+    breaker.opened_at -= config["breaker_open_seconds"]
+    for i in range(config["breaker_half_open_probes"]):
+        assert client.get(f"/api/channels/probe{i}").status_code == 200
+        expected = CircuitBreaker.CLOSED if i == config["breaker_half_open_probes"] - 1 else CircuitBreaker.HALF_OPEN
+        assert breaker.state == expected
+    assert len(upstream.requests) == sent + config["breaker_half_open_probes"]
+
+
+def test_failed_probe_opens_the_circuit_again(client, upstream):
+    upstream.handler = lambda request: httpx.Response(503)
+    config = GatewayService.get_service_config("channels")
+    for i in range(config["breaker_min_calls"]):
+        client.get(f"/api/channels/c{i}")
+    breaker = GatewayService.get_breaker("channels")
+    opened = breaker.times_opened
+
+    breaker.opened_at -= config["breaker_open_seconds"]
+    assert client.get("/api/channels/probe").status_code == 503
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == opened + 1
@@ -0,0 +1,39 @@
+"""Bot commands run as asynchronous jobs: only the caller that submitted a job can read it"""
+import httpx
+
+OWNER = {"Authorization": "Bearer owner-token"}
+OTHER = {"Authorization": "Bearer other-token"}
+
+
+def wikipedia_service(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, json={"response": "Python is a programming language"})
+
+
+def submit(client) -> str:
+    response = client.post("/api/commands/wikipedia?async=true", json={"message": "python"}, headers=OWNER)
+    assert response.status_code == 202
+    assert response.headers["location"] == response.json()["location"]
+    return response.headers["location"]
+
+
+def test_owner_gets_the_answer(client, upstream):
+    upstream.handler = wikipedia_service
+    location = submit(client)
+
+    response = client.get(f"{location}?wait=5", headers=OWNER)
+    assert response.status_code == 200
+    assert response.json() == {"response": "Python is a programming language"}
+
+
+def test_other_callers_get_404(client, upstream):
+    upstream.handler = wikipedia_service
+    location = submit(client)
+
+    assert client.get(f"{location}?wait=5", headers=OTHER).status_code == 404
+    assert client.get(location).status_code == 404
+    # Still there for its owner
+    assert client.get(f"{location}?wait=5", headers=OWNER).status_code == 200
+
+
+def test_unknown_job_is_404(client):
+    assert client.get("/api/commands/jobs/does-not-exist", headers=OWNER).status_code == 404
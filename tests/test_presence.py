@@ -0,0 +1,75 @@
+"""Presence served from the gateway table: who may change or remove a user's presence"""
+import httpx
+
+import api_gateway
+
+OWNER = {"Authorization": "Bearer owner-token"}
+OTHER = {"Authorization": "Bearer other-token"}
+
+
+def presence_service(request: httpx.Request) -> httpx.Response:
+    token = request.headers.get("authorization")
+    if request.url.path.endswith("/v1/users/me"):
+        if token == OWNER["Authorization"]:
+            return httpx.Response(200, json={"id": "u1"})
+        if token == OTHER["Authorization"]:
+            return httpx.Response(200, json={"id": "u2"})
+        return httpx.Response(401, json={"detail": "Invalid token"})
+    if request.method == "DELETE":
+        # The presence service only lets users delete their own presence
+        if token == OWNER["Authorization"] and request.url.path.endswith("/u1"):
+            return httpx.Response(204)
+        return httpx.Response(403 if token else 401, json={"detail": "Forbidden"})
+    return httpx.Response(200, json=[])
+
+
+def test_delete_rejected_upstream_keeps_the_user(client, upstream):
+    upstream.handler = presence_service
+    api_gateway.presence_table.record("u1", {"status": "online"})
+
+    assert client.delete("/api/presence/u1").status_code == 401
+    assert client.delete("/api/presence/u1", headers=OTHER).status_code == 403
+    assert api_gateway.presence_table.get("u1") is not None
+    assert client.get("/api/presence/stats", headers=OWNER).json()["online"] == 1
+
+
+def test_accepted_delete_removes_the_user(client, upstream):
+    upstream.handler = presence_service
+    api_gateway.presence_table.record("u1", {"status": "online"})
+
+    assert client.delete("/api/presence/u1", headers=OWNER).status_code == 204
+    assert api_gateway.presence_table.get("u1") is None
+    assert client.get("/api/presence/stats", headers=OWNER).json()["total"] == 0
+
+
+def test_table_reads_require_a_token(client, upstream):
+    upstream.handler = presence_service
+    api_gateway.presence_table.record("u1", {"status": "online"})
+
+    assert client.get("/api/presence").status_code == 401
+    assert client.get("/api/presence/stats").status_code == 401
+    assert client.get("/api/presence/u1").status_code == 401
+    assert [record["userId"] for record in client.get("/api/presence", headers=OWNER).json()] == ["u1"]
+
+
+def test_heartbeats_only_for_the_caller_itself(client, upstream):
+    upstream.handler = presence_service
+
+    assert client.patch("/api/presence/u1", json={"status": "online"}).status_code == 401
+    assert client.patch("/api/presence/u1", json={"status": "online"}, headers=OTHER).status_code == 403
+    assert client.patch("/api/presence/u1", json=["online"], headers=OWNER).status_code == 422
+    assert client.patch("/api/presence/u1", json={"status": "away"}, headers=OWNER).json()["status"] == "away"
+
+
+def test_heartbeat_rejected_at_flush_is_evicted(client, upstream):
+    def rejecting(request: httpx.Request) -> httpx.Response:
+        if request.method == "PATCH":
+            return httpx.Response(404, json={"detail": "Unknown user"})
+        return presence_service(request)
+    upstream.handler = rejecting
+
+    client.patch("/api/presence/u1", json={"status": "online"}, headers=OWNER)
+    assert api_gateway.presence_table.get("u1") is not None
+    client.portal.call(api_gateway.presence_table.flush)
+    assert api_gateway.presence_table.get("u1") is None
+    assert api_gateway.presence_table.flush_failures == 1
@@ -0,0 +1,45 @@
+"""Token-bucket rate limits per user and per client address"""
+import httpx
+import pytest
+
+import api_gateway
+from api_gateway import RATE_LIMITS, RateLimiter
+
+
+@pytest.fixture
+def limited(client, monkeypatch):
+    """The client with rate limiting on and a login burst of 2 per address"""
+    monkeypatch.setattr(api_gateway, "RATE_LIMITING_ENABLED", True)
+    monkeypatch.setattr(api_gateway, "rate_limiter",
+                        RateLimiter({**RATE_LIMITS, "auth": {"user": (1.0, 2), "ip": (0.5, 2)}}))
+    return client
+
+
+def test_burst_then_429_with_retry_after(limited, upstream):
+    upstream.handler = lambda request: httpx.Response(200, json={"access_token": "t"})
+    credentials = {"email": "a@example.com", "password": "secret"}
+
+    for _ in range(2):
+        assert limited.post("/api/users/login", json=credentials).status_code == 200
+    response = limited.post("/api/users/login", json=credentials)
+
+    assert response.status_code == 429
+    # One token refills at 0.5/s
+    assert response.headers["retry-after"] == "2"
+    assert len(upstream.requests) == 2
+
+
+def test_addresses_are_limited_separately(limited, upstream):
+    upstream.handler = lambda request: httpx.Response(200, json={"access_token": "t"})
+    credentials = {"email": "a@example.com", "password": "secret"}
+
+    for _ in range(2):
+        limited.post("/api/users/login", json=credentials, headers={"X-Real-IP": "10.0.0.1"})
+    assert limited.post("/api/users/login", json=credentials, headers={"X-Real-IP": "10.0.0.1"}).status_code == 429
+    assert limited.post("/api/users/login", json=credentials, headers={"X-Real-IP": "10.0.0.2"}).status_code == 200
+
+
+def test_unlimited_routes_are_not_counted(limited, upstream):
+    upstream.handler = lambda request: httpx.Response(200, json=[])
+    for _ in range(5):
+        assert limited.get("/api/channels").status_code == 200
@@ -0,0 +1,55 @@
+"""Response cache of the channel and thread GETs and its invalidation on writes"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from conftest import wait_for
+
+
+def channels_service(state: dict, release: threading.Event):
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "PUT":
+            state["version"] += 1
+            return httpx.Response(200, json={"id": "c1", "version": state["version"]})
+        # Read before the write, answered after it
+        version = state["version"]
+        await wait_for(release)
+        return httpx.Response(200, json={"id": "c1", "version": version})
+    return handler
+
+
+def test_get_is_cached_until_a_write_invalidates_it(client, upstream):
+    release = threading.Event()
+    release.set()
+    upstream.handler = channels_service({"version": 0}, release)
+
+    first = client.get("/api/channels/c1")
+    second = client.get("/api/channels/c1")
+    assert second.headers["x-cache"] == "HIT"
+    assert second.json() == first.json()
+
+    client.put("/api/channels/c1", json={"name": "general"})
+    third = client.get("/api/channels/c1")
+    assert "x-cache" not in third.headers
+    assert third.json()["version"] == 1
+
+
+def test_response_fetched_before_a_write_is_not_cached(client, upstream):
+    release = threading.Event()
+    upstream.handler = channels_service({"version": 0}, release)
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        stale = pool.submit(client.get, "/api/channels/c1")
+        while upstream.calls("GET", "/v1/channels/c1") == 0:
+            time.sleep(0.01)
+        # The write (and its invalidation) completes while the GET is still waiting for its answer
+        client.put("/api/channels/c1", json={"name": "general"})
+        release.set()
+        assert stale.result(timeout=5).json()["version"] == 0
+
+    fresh = client.get("/api/channels/c1")
+    assert "x-cache" not in fresh.headers
+    assert fresh.json()["version"] == 1
+    assert client.get("/cache/stats").json()["stale_writes"] == 1
@@ -0,0 +1,61 @@
+"""Search debouncing: a newer search from the same search box supersedes the one in flight"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+from conftest import wait_for
+
+USER = {"Authorization": "Bearer user-token"}
+
+
+@pytest.fixture
+def slow_first_search(upstream):
+    """Searches for "first" wait until released, the others are answered right away"""
+    release = threading.Event()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.params.get("q") == "first":
+            await wait_for(release)
+        return httpx.Response(200, json={"results": [], "total": 0})
+
+    upstream.handler = handler
+    yield release
+    release.set()
+
+
+def search_pair(client, upstream, first_client: str, second_client: str):
+    """Send a search and, while it is in flight, a second one; return both responses"""
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        first = pool.submit(client.get, "/api/search/files", params={"q": "first"},
+                            headers={**USER, "X-Search-Client": first_client})
+        while not upstream.requests:
+            time.sleep(0.01)
+        second = client.get("/api/search/files", params={"q": "second"},
+                            headers={**USER, "X-Search-Client": second_client})
+        return first.result(timeout=5), second
+
+
+def test_superseded_search_gets_409(client, upstream, slow_first_search):
+    first, second = search_pair(client, upstream, "box-1", "box-1")
+
+    assert first.status_code == 409
+    assert first.json()["detail"] == "Superseded by a newer search"
+    assert second.status_code == 200
+    assert client.get("/cache/stats").json()["search_superseded"] == 1
+
+
+def test_other_search_boxes_do_not_supersede(client, upstream, slow_first_search):
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # The first search only finishes once released, after the second one answered
+        pending = pool.submit(search_pair, client, upstream, "box-1", "box-2")
+        while len(upstream.requests) < 2:
+            time.sleep(0.01)
+        slow_first_search.set()
+        first, second = pending.result(timeout=5)
+
+    assert first.status_code == 200
+    assert second.status_code == 200
+    assert client.get("/cache/stats").json()["search_superseded"] == 0